@@ -0,0 +1,190 @@
+#
+# The AsyncHueServer object.
+#
+# The asyncio Hue server, used instead of hue_upnp when hue_server is asyncio.
+# It serves the same HueApi as the native HueServer, but all connections are
+# handled by one event loop instead of a thread each.  Connections are kept
+# alive and pipelined requests are answered in order, each response is sent
+# with a single write.  Requests that change a light can wait for the ISY, so
+# they are handled by a few worker threads, the rest are answered from the
+# HueState right away.
+#
+
+import asyncio
+import logging
+from http import HTTPStatus
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from SSDPResponder import SSDPResponder
+
+LOGGER = logging.getLogger(__name__)
+
+class AsyncHueServer():
+
+    # Seconds an idle keep-alive connection is kept open
+    idle_timeout = 60.0
+    # Max size of the request line and headers
+    max_header   = 16384
+
+    def __init__(self,apis,ssdp_rate=2.0,workers=4):
+        self.apis      = apis
+        self.ssdp_rate = ssdp_rate
+        self.workers   = workers
+        self.loop      = None
+        self.executor  = None
+        self.servers   = []
+        # The open connections, closed on stop
+        self.writers   = set()
+        self.ssdp      = None
+        self.running   = False
+        # Set by stop, so a stop before run is not lost
+        self.stopped   = False
+        self.stats     = {'connections': 0, 'open': 0, 'requests': 0, 'workers': 0, 'errors': 0}
+
+    def run(self,listen=False):
+        # Blocks until stop is called, like hue_upnp.run.  SSDP answers when
+        # the parent is listening so listen is not used here.
+        if self.stopped:
+            LOGGER.info('Stopped before it was started')
+            return
+        self.running  = True
+        self.loop     = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers,thread_name_prefix='HueWorker')
+        try:
+            for api in self.apis:
+                self.servers.append(self.loop.run_until_complete(
+                    asyncio.start_server(partial(self.serve,api),'',api.port,limit=self.max_header)))
+                LOGGER.info('Serving Hue API on {}:{} bridge={} listen={}'.format(api.host,api.port,api.bridge['bridgeid'],listen))
+            self.ssdp = SSDPResponder(self.apis,self.ssdp_rate)
+            try:
+                self.ssdp.start()
+            except OSError as ex:
+                LOGGER.error('Unable to start SSDP, discovery will not work: {}'.format(ex), exc_info=True)
+                self.ssdp = None
+            # stop may have been called while starting
+            if not self.stopped:
+                self.loop.run_forever()
+        finally:
+            # stop doesn't see an SSDP started after it
+            if self.ssdp is not None:
+                self.ssdp.stop()
+            for server in self.servers:
+                server.close()
+            for writer in list(self.writers):
+                writer.close()
+            # Let the connections see they are closed before waiting for the servers
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks,return_exceptions=True))
+            for server in self.servers:
+                self.loop.run_until_complete(server.wait_closed())
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+        LOGGER.info('Stopped')
+
+    def stop(self):
+        self.stopped = True
+        self.running = False
+        if self.ssdp is not None:
+            self.ssdp.stop()
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    # Same as hue_upnp, but the SSDPResponder checks the parent listening.
+    def start_listener(self):
+        pass
+
+    def stop_listener(self):
+        pass
+
+    async def serve(self,api,reader,writer):
+        # One connection, the requests are read and answered in order until it's closed.
+        self.stats['connections'] += 1
+        self.stats['open'] += 1
+        self.writers.add(writer)
+        peer = writer.get_extra_info('peername')
+        try:
+            keep_alive = True
+            while keep_alive and self.running:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),self.idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(self.response(431,'text/plain','Request Header Fields Too Large',False))
+                    break
+                request = self.parse(head)
+                if request is None:
+                    writer.write(self.response(400,'text/plain','Bad Request',False))
+                    break
+                (method,path,headers,keep_alive) = request
+                if 'chunked' in headers.get('transfer-encoding',''):
+                    writer.write(self.response(501,'text/plain','Not Implemented',False))
+                    break
+                try:
+                    length = int(headers.get('content-length',0))
+                    body = (await reader.readexactly(length)).decode('utf-8') if length > 0 else ''
+                except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                self.stats['requests'] += 1
+                writer.write(await self.respond(api,method,path,body,keep_alive))
+                await writer.drain()
+        except ConnectionError as ex:
+            LOGGER.debug('{} connection lost: {}'.format(peer,ex))
+        except asyncio.CancelledError:
+            # Stopping, asyncio logs an error for a connection task that ends cancelled
+            pass
+        finally:
+            self.stats['open'] -= 1
+            self.writers.discard(writer)
+            writer.close()
+
+    async def respond(self,api,method,path,body,keep_alive):
+        try:
+            if method == 'GET':
+                # Answered from the HueState, doesn't wait for anything
+                (status,ctype,data) = api.handle(method,path,body)
+            else:
+                self.stats['workers'] += 1
+                (status,ctype,data) = await self.loop.run_in_executor(self.executor,api.handle,method,path,body)
+        except Exception as ex:
+            LOGGER.error('{} {} failed: {}'.format(method,path,ex), exc_info=True)
+            self.stats['errors'] += 1
+            (status,ctype,data) = (500,'text/plain','Internal Server Error')
+        LOGGER.debug('%s %s %s',method,path,status)
+        return self.response(status,ctype,data,keep_alive)
+
+    @staticmethod
+    def parse(head):
+        # Returns (method,path,headers,keep_alive) or None when it's not a request we understand
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            return None
+        (method,path,version) = parts
+        headers = dict()
+        for line in lines[1:]:
+            if line == '':
+                continue
+            (name,sep,value) = line.partition(':')
+            if sep == '':
+                return None
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get('connection','').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+        return (method,path,headers,keep_alive)
+
+    @staticmethod
+    def response(status,ctype,data,keep_alive):
+        data = data.encode('utf-8')
+        head = 'HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n{}\r\n'.format(
+            status,HTTPStatus(status).phrase,ctype,len(data),'' if keep_alive else 'Connection: close\r\n')
+        return head.encode('latin-1') + data
+
+    def get_stats(self):
+        return dict(self.stats)
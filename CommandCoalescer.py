@@ -0,0 +1,122 @@
+#
+# The CommandCoalescer object.
+#
+# Holding a dim button on a remote sends a burst of Hue brightness commands,
+# sending each one to the ISY makes it fall behind.  Each device has a
+# coalescer which sends a command right away and then waits window seconds,
+# only the last command received in that time is sent when it ends.  So a
+# single command is never delayed and a burst is one command per window.
+# Commands that match the current state of the device are dropped.
+#
+
+import logging
+from threading import Timer,Lock
+
+LOGGER = logging.getLogger(__name__)
+
+class CommandCoalescer():
+
+    def __init__(self,name,window,send,state):
+        """
+        send(cmd,value) sends the command to the ISY, cmd is one of 'on', 'off',
+        'bri', 'fade_up' or 'fade_down'.  When it returns True done() must be called when the command is
+        finished.  state() returns the (on,bri) last reported by the ISY, or
+        None when commands should never be dropped.
+        """
+        self.name      = name
+        self.window    = window
+        self.send_cmd  = send
+        self.state     = state
+        self.lock      = Lock()
+        # Only one send at a time so they stay in order
+        self.send_lock = Lock()
+        self.pending   = None
+        self.timer     = None
+        # Commands sent but not done yet, while there are any the ISY status
+        # is out of date so compare with the last one sent.
+        self.inflight  = 0
+        self.last      = None
+        self.stats     = {'received': 0, 'coalesced': 0, 'dropped': 0, 'sent': 0}
+
+    def submit(self,cmd,value=None):
+        if cmd == 'bri' and int(value) == 0:
+            (cmd,value) = ('off',None)
+        with self.lock:
+            self.stats['received'] += 1
+            if self.timer is not None:
+                # In the window after a command, it's sent when the window ends.
+                # On after a brightness keeps the brightness, anything else replaces it.
+                last = self.pending if self.pending is not None else self.last
+                if cmd == 'on' and last is not None and last[0] == 'bri':
+                    self.stats['coalesced'] += 1
+                elif self.pending is not None:
+                    self.stats['coalesced'] += 1
+                    self.pending = (cmd,value)
+                else:
+                    self.pending = (cmd,value)
+                LOGGER.debug('{} coalesced {} {} pending={}'.format(self.name,cmd,value,self.pending))
+                return True
+            self.pending = (cmd,value)
+            if self.window > 0:
+                self.start_window()
+        return self.flush()
+
+    def start_window(self):
+        # Must be called with the lock held
+        self.timer = Timer(self.window,self.window_end)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def window_end(self):
+        with self.lock:
+            self.timer = None
+            if self.pending is None:
+                return True
+            # The commands after this one wait for another window
+            self.start_window()
+        return self.flush()
+
+    def flush(self):
+        with self.send_lock:
+            with self.lock:
+                if self.pending is None:
+                    # Cancelled, or sent by another flush
+                    return True
+                (cmd,value) = self.pending
+                self.pending = None
+                if (self.last == (cmd,value)) if self.inflight > 0 else self.matches(cmd,value):
+                    LOGGER.debug('{} dropped {} {}, already in that state'.format(self.name,cmd,value))
+                    self.stats['dropped'] += 1
+                    return True
+                self.inflight += 1
+                self.last = (cmd,value)
+            self.stats['sent'] += 1
+            ret = self.send_cmd(cmd,value)
+            if ret is False:
+                self.done()
+            return ret
+
+    def done(self):
+        # Must be called when a command returned True by send is done
+        with self.lock:
+            self.inflight = max(0,self.inflight - 1)
+
+    def matches(self,cmd,value):
+        state = self.state()
+        if state is None:
+            return False
+        (on,bri) = state
+        if cmd in ['fade_up', 'fade_down']:
+            return False
+        if cmd == 'off':
+            return not on
+        if cmd == 'on':
+            return on
+        return on and int(bri) == int(value)
+
+    def cancel(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer   = None
+            self.pending = None
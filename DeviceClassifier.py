@@ -0,0 +1,132 @@
+#
+# The DeviceClassifier object.
+#
+# Decides the Hue type of an ISY node from a table of rules, the first rule
+# that matches wins.  A rule can match the node protocol, node_def_id, type,
+# dimmable and an address pattern.  Everything but the address is the same
+# for all nodes of a kind, so the rules that can match each kind are only
+# worked out once and only the address patterns are checked for each node.
+# The device_types option adds rules in front of these, so a new device quirk
+# doesn't need a code change.
+#
+
+import re
+import logging
+import pyisy
+
+LOGGER = logging.getLogger(__name__)
+
+# Each rule has the values it matches, the Hue type it gives, if brightness
+# is sent to the node, if commands always go to the scene, and if the node
+# can fade on its own for a Hue transitiontime.
+RULES = [
+    # We assume scenes are dimmable, although we don't handle this properly yet...
+    {'rule': 'scene',      'match': {'protocol': pyisy.constants.PROTO_GROUP},
+        'type': 'Dimmable light', 'dimmable': False, 'set_scene': True,  'fade': False},
+    # Matchs KPL buttons except the main one, since that is dimmable and the others are not.
+    {'rule': 'kpl_button', 'match': {'dimmable': True, 'address': r'^[0-9A-F]{2}\s[0-9A-F]{2}\s[0-9A-F]{2}\s[2-9]+'},
+        'type': 'On/off light',   'dimmable': False, 'set_scene': False, 'fade': False},
+    # Insteon dimmers fade at their ramp rate with a fade up or down command.
+    {'rule': 'insteon_dimmer', 'match': {'protocol': pyisy.constants.PROTO_INSTEON, 'dimmable': True},
+        'type': 'Dimmable light', 'dimmable': True,  'set_scene': False, 'fade': True},
+    {'rule': 'dimmable',   'match': {'dimmable': True},
+        'type': 'Dimmable light', 'dimmable': True,  'set_scene': False, 'fade': False},
+    {'rule': 'default',    'match': {},
+        'type': 'On/off light',   'dimmable': False, 'set_scene': False, 'fade': False},
+]
+
+# The kinds for device_types, scene is for nodes that can't be controlled
+# directly, like KPL buttons, so the scene they control is used instead, and
+# fade is a dimmable that supports the Insteon fade commands.
+KINDS = {
+    'dimmable': {'type': 'Dimmable light', 'dimmable': True,  'set_scene': False, 'fade': False},
+    'fade':     {'type': 'Dimmable light', 'dimmable': True,  'set_scene': False, 'fade': True},
+    'onoff':    {'type': 'On/off light',   'dimmable': False, 'set_scene': False, 'fade': False},
+    'scene':    {'type': 'On/off light',   'dimmable': False, 'set_scene': True,  'fade': False},
+}
+
+class DeviceClassifier():
+
+    def __init__(self,overrides=''):
+        """
+        overrides is the device_types option, a comma separated list of
+        key=kind, where key is a node_def_id, node type or address and kind
+        is dimmable, fade, onoff or scene.
+        """
+        self.rules   = self.compile(self.parse(overrides) + RULES)
+        # (protocol,node_def_id,type,dimmable): [(rule,address match or None)], the rules that can match nodes like that
+        self.cache   = dict()
+        # rule: times it matched
+        self.matched = dict()
+        self.stats   = {'kinds': 0, 'cached': 0, 'patterns': 0}
+
+    @staticmethod
+    def parse(overrides):
+        rules = []
+        for item in overrides.split(','):
+            if item.strip() == '':
+                continue
+            (key,sep,kind) = item.partition('=')
+            (key,kind) = (key.strip(),kind.strip().lower())
+            if sep == '' or key == '' or kind not in KINDS:
+                LOGGER.error('Ignoring device_types {}, it should be key=kind where kind is one of {}'.format(item,', '.join(KINDS)))
+                continue
+            rule = {'rule': 'device_types {}={}'.format(key,kind), 'match': {'key': key}}
+            rule.update(KINDS[kind])
+            rules.append(rule)
+        return rules
+
+    @staticmethod
+    def compile(rules):
+        for rule in rules:
+            if 'address' in rule['match']:
+                rule['pattern'] = re.compile(rule['match']['address'])
+        return rules
+
+    def candidates(self,protocol,node_def_id,ntype,dimmable):
+        # The rules that can match nodes with these values, up to the first one that always does.
+        values = {'protocol': protocol, 'node_def_id': node_def_id, 'type': ntype, 'dimmable': dimmable}
+        ret = []
+        for rule in self.rules:
+            match = rule['match']
+            if any(values[key] != value for key, value in match.items() if key in values):
+                continue
+            address = None
+            if 'key' in match:
+                if match['key'] not in [node_def_id, ntype]:
+                    # Must be an address
+                    address = address_is(match['key'])
+            elif 'pattern' in rule:
+                address = rule['pattern'].match
+            ret.append((rule,address))
+            if address is None:
+                break
+        return ret
+
+    def classify(self,node):
+        """
+        Returns the rule for the node, with the Hue type, dimmable, set_scene and fade.
+        """
+        key = (node.protocol,getattr(node,'node_def_id',None),getattr(node,'type',None),getattr(node,'dimmable',None) is True)
+        candidates = self.cache.get(key)
+        if candidates is None:
+            candidates = self.cache[key] = self.candidates(*key)
+            self.stats['kinds'] += 1
+        else:
+            self.stats['cached'] += 1
+        for (rule,address) in candidates:
+            if address is not None:
+                self.stats['patterns'] += 1
+                if not address(node.address):
+                    continue
+            self.matched[rule['rule']] = self.matched.get(rule['rule'],0) + 1
+            return rule
+        # Can't happen, the last rule matches everything
+        return RULES[-1]
+
+    def get_stats(self):
+        return dict(self.stats,matched=dict(self.matched))
+
+def address_is(value):
+    # A match function for an address that must be the same
+    return lambda address: address == value
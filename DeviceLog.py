@@ -0,0 +1,73 @@
+#
+# The DeviceLog object.
+#
+# Logging for the busy paths of a device handler, ISY status events and Hue
+# commands.  Every message is kept unformatted in a small ring buffer that
+# can be dumped on demand, and only some are passed on to the log: the first
+# burst of each interval, then one of every sample.  Messages are only
+# formatted when they are logged or dumped, the same as logging does.
+#
+
+import time
+import logging
+from collections import deque
+
+LOGGER = logging.getLogger(__name__)
+
+class DeviceLog():
+
+    # Recent messages kept for each device
+    size     = 50
+    # Seconds the burst count is for
+    interval = 10.0
+
+    def __init__(self,logger,name,burst=5,sample=20):
+        """
+        logger is where the messages go, name is added to each message.
+        burst messages are logged each interval, after that one of every
+        sample.  A sample of 1 logs all messages.
+        """
+        self.logger     = logger
+        self.name       = name
+        self.burst      = max(0,burst)
+        self.sample     = max(1,sample)
+        # (time, level, msg, args)
+        self.recent     = deque(maxlen=self.size)
+        self.start      = 0
+        self.count      = 0
+        self.suppressed = 0
+
+    def debug(self,msg,*args):
+        self.log(logging.DEBUG,msg,*args)
+
+    def info(self,msg,*args):
+        self.log(logging.INFO,msg,*args)
+
+    def log(self,level,msg,*args):
+        now = time.time()
+        self.recent.append((now,level,msg,args))
+        if not self.logger.isEnabledFor(level):
+            return
+        if now - self.start >= self.interval:
+            if self.suppressed > 0:
+                self.logger.log(level,'%s %d messages not logged in the last %d seconds, see Dump Log',self.name,self.suppressed,now - self.start)
+            self.start      = now
+            self.count      = 0
+            self.suppressed = 0
+        # Not locked, an off by one count from another thread doesn't matter here.
+        self.count += 1
+        if self.sample == 1 or self.count <= self.burst or self.count % self.sample == 0:
+            self.logger.log(level,'%s ' + msg,self.name,*args)
+        else:
+            self.suppressed += 1
+
+    def dump(self):
+        # The recent messages formatted, oldest first
+        lines = []
+        for (st,level,msg,args) in list(self.recent):
+            try:
+                text = msg % args if args else msg
+            except (TypeError, ValueError) as ex:
+                text = '{} {} ({})'.format(msg,args,ex)
+            lines.append('{}.{:03d} {} {} {}'.format(time.strftime('%H:%M:%S',time.localtime(st)),int(st * 1000) % 1000,logging.getLevelName(level),self.name,text))
+        return lines
@@ -0,0 +1,264 @@
+#
+# The DeviceRegistry object.
+#
+# The saved devices, groups, notes and settings, kept in a SQLite database
+# in the config folder instead of rewriting config.json.  Everything is
+# loaded into dicts indexed by ISY address, spoken name and Hue index, and
+# a save only writes the rows that changed since the last one, in a single
+# transaction so a crash can't lose the Hue index of any device.  Each time
+# an index is given to a different address or name it's added to the history.
+# A config.json from an older version is imported when it's found.
+#
+
+import os
+import json
+import time
+import sqlite3
+import logging
+from threading import Lock
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    idx   INTEGER PRIMARY KEY,
+    id    TEXT NOT NULL,
+    name  TEXT NOT NULL,
+    type  TEXT,
+    on_   TEXT,
+    bri   INTEGER
+);
+CREATE INDEX IF NOT EXISTS devices_id ON devices (id);
+CREATE INDEX IF NOT EXISTS devices_name ON devices (name);
+CREATE TABLE IF NOT EXISTS groups (
+    idx   INTEGER PRIMARY KEY,
+    id    TEXT NOT NULL UNIQUE,
+    name  TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS notes (
+    address TEXT PRIMARY KEY,
+    spoken  TEXT,
+    sig     TEXT,
+    checked REAL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS history (
+    time  REAL NOT NULL,
+    idx   INTEGER NOT NULL,
+    id    TEXT NOT NULL,
+    name  TEXT NOT NULL,
+    event TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_idx ON history (idx);
+"""
+
+# The device columns and the item keys they are saved from
+DEVICE_KEYS = ['index', 'id', 'name', 'type', 'on', 'bri']
+
+class DeviceRegistry():
+
+    def __init__(self,path='config/registry.db',legacy='config/config.json'):
+        self.path    = path
+        self.legacy  = legacy
+        self.lock    = Lock()
+        self.db      = None
+        # index: {'index', 'id', 'name', 'type', 'on', 'bri'}, the same items as config['devices'] was
+        self.items   = dict()
+        self.ids     = dict()
+        self.names   = dict()
+        self.last    = -1
+        # id: {'index', 'id', 'name'}
+        self.groups  = dict()
+        # Saved with NotesCache.copy(), address: {'spoken', 'sig', 'checked'}
+        self.notes   = dict()
+        # Anything else, saved as json, like the bridge identity
+        self.config  = dict()
+        # The history not saved yet, and the last (id,name) of each index
+        self.history = []
+        self.assigned = dict()
+        # What was last saved, to only write what changed
+        self.saved   = {'devices': dict(), 'groups': dict(), 'notes': dict(), 'settings': dict()}
+        self.writes  = 0
+
+    def open(self):
+        self.db = sqlite3.connect(self.path,check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        if os.path.exists(self.legacy):
+            self.migrate()
+        self.load()
+        LOGGER.info('{}: {} devices {} groups {} notes'.format(self.path,len(self.items),len(self.groups),len(self.notes)))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def load(self):
+        with self.lock:
+            for row in self.db.execute('SELECT idx,id,name,type,on_,bri FROM devices'):
+                item = dict(zip(DEVICE_KEYS,row))
+                # Devices that were never seen with the ISY connected have no state for a warm start
+                for key in ['type', 'on', 'bri']:
+                    if item[key] is None:
+                        del item[key]
+                self.index(item)
+                self.saved['devices'][item['index']] = self.device_row(item)
+            for (idx,id,name) in self.db.execute('SELECT idx,id,name FROM groups'):
+                self.groups[id] = {'index': idx, 'id': id, 'name': name}
+                self.saved['groups'][id] = (idx,id,name)
+            for (address,spoken,sig,checked) in self.db.execute('SELECT address,spoken,sig,checked FROM notes'):
+                self.notes[address] = {'spoken': spoken, 'sig': sig, 'checked': checked}
+                self.saved['notes'][address] = (spoken,sig,checked)
+            for (key,value) in self.db.execute('SELECT key,value FROM settings'):
+                self.config[key] = json.loads(value)
+                self.saved['settings'][key] = value
+            for (idx,id,name) in self.db.execute('SELECT idx,id,name FROM history ORDER BY time'):
+                self.assigned[idx] = (id,name)
+
+    def migrate(self):
+        """
+        Import a config.json from an older version, or one copied from another
+        install, it replaces the saved devices.  It's renamed so it's only imported once.
+        """
+        LOGGER.warning('Importing {} into {}'.format(self.legacy,self.path))
+        try:
+            with open(self.legacy,'r') as ifile:
+                config = json.load(ifile)
+        except (OSError, ValueError) as ex:
+            LOGGER.error('Unable to import {}: {}'.format(self.legacy,ex))
+            return
+        for item in config.get('devices',[]):
+            self.index(dict(item))
+            self.assign(item,item['id'],item['name'],'imported')
+        for item in config.get('groups',[]):
+            self.groups[item['id']] = dict(item)
+        self.notes.update(config.get('notes',dict()))
+        if 'bridge' in config:
+            self.config['bridge'] = config['bridge']
+        with self.db:
+            for table in ['devices', 'groups', 'notes']:
+                self.db.execute('DELETE FROM {}'.format(table))
+        self.save()
+        os.replace(self.legacy,self.legacy + '.imported')
+        # Start over from what was saved
+        self.items   = dict()
+        self.ids     = dict()
+        self.names   = dict()
+        self.last    = -1
+        self.groups  = dict()
+        self.notes   = dict()
+        self.config  = dict()
+
+    def index(self,item):
+        self.items[item['index']] = item
+        self.last = max(self.last,item['index'])
+        self.ids.setdefault(item['id'],item)
+        self.names.setdefault(item['name'],item)
+
+    #
+    # Devices
+    #
+    def find(self,id,name):
+        # The item for the ISY address, or the spoken name if the address is new, or None.
+        item = self.ids.get(id)
+        if item is None:
+            item = self.names.get(name)
+        return item
+
+    def add(self,id,name,type,index=None):
+        # A new device with the next free index unless one is given.
+        if index is None:
+            index = self.max_index() + 1
+        item = {'index': index, 'id': id, 'name': name, 'type': type}
+        self.index(item)
+        self.assign(item,id,name,'added')
+        return item
+
+    def assign(self,item,id,name,event='assigned'):
+        # Record the index being used by a device, only when it's a different address or name than the last time.
+        if self.assigned.get(item['index']) == (id,name):
+            return
+        self.assigned[item['index']] = (id,name)
+        self.history.append((time.time(),item['index'],id,name,event))
+
+    def max_index(self):
+        return self.last
+
+    def devices(self):
+        # Sorted by index
+        return [self.items[index] for index in sorted(self.items)]
+
+    def get_history(self,index):
+        # [(time,id,name,event)] of an index, oldest first
+        if self.db is None:
+            return []
+        with self.lock:
+            return [row for row in self.db.execute('SELECT time,id,name,event FROM history WHERE idx=? ORDER BY time',(index,))]
+
+    #
+    # Groups
+    #
+    def add_group(self,id,name):
+        item = {'index': len(self.groups), 'id': id, 'name': name}
+        self.groups[id] = item
+        return item
+
+    @staticmethod
+    def device_row(item):
+        return (item['index'],item['id'],item['name'],item.get('type'),item.get('on'),item.get('bri'))
+
+    def save(self,new_notes=None):
+        """
+        Write the devices, groups, settings and notes that changed since the
+        last save.  new_notes replaces the notes when it's given.
+        """
+        with self.lock:
+            if new_notes is not None:
+                self.notes = new_notes
+            if self.db is None:
+                return 0
+            saved = self.saved
+            devices  = {index: self.device_row(item) for index, item in self.items.items()}
+            groups   = {id: (item['index'],item['id'],item['name']) for id, item in self.groups.items()}
+            notes    = {address: (item.get('spoken'),item.get('sig'),item.get('checked')) for address, item in self.notes.items()}
+            settings = {key: json.dumps(value,sort_keys=True) for key, value in self.config.items()}
+            history  = self.history
+            writes = 0
+            # The with commits all of it or, on an exception, none of it.
+            with self.db:
+                for index, row in devices.items():
+                    if saved['devices'].get(index) != row:
+                        self.db.execute('INSERT OR REPLACE INTO devices (idx,id,name,type,on_,bri) VALUES (?,?,?,?,?,?)',row)
+                        writes += 1
+                for index in [index for index in saved['devices'] if index not in devices]:
+                    self.db.execute('DELETE FROM devices WHERE idx=?',(index,))
+                    writes += 1
+                for id, row in groups.items():
+                    if saved['groups'].get(id) != row:
+                        self.db.execute('INSERT OR REPLACE INTO groups (idx,id,name) VALUES (?,?,?)',row)
+                        writes += 1
+                for address, row in notes.items():
+                    if saved['notes'].get(address) != row:
+                        self.db.execute('INSERT OR REPLACE INTO notes (address,spoken,sig,checked) VALUES (?,?,?,?)',(address,) + row)
+                        writes += 1
+                for address in [address for address in saved['notes'] if address not in notes]:
+                    self.db.execute('DELETE FROM notes WHERE address=?',(address,))
+                    writes += 1
+                for key, value in settings.items():
+                    if saved['settings'].get(key) != value:
+                        self.db.execute('INSERT OR REPLACE INTO settings (key,value) VALUES (?,?)',(key,value))
+                        writes += 1
+                if len(history) > 0:
+                    self.db.executemany('INSERT INTO history (time,idx,id,name,event) VALUES (?,?,?,?,?)',history)
+                    writes += len(history)
+            self.saved   = {'devices': devices, 'groups': groups, 'notes': notes, 'settings': settings}
+            self.history = []
+            self.writes += writes
+        LOGGER.debug('Saved {} changes to {}'.format(writes,self.path))
+        return writes
+
+    def stats(self):
+        return {'devices': len(self.items), 'groups': len(self.groups), 'notes': len(self.notes), 'writes': self.writes}
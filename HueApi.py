@@ -0,0 +1,305 @@
+#
+# The HueApi object.
+#
+# Answers the Hue REST API for the native Hue server, using the serialized
+# lights from the parent HueState and the Hue groups made from ISY scenes.
+# It only knows about paths and bodies so it can be used by any front end.
+# Each bridge has its own HueApi that only shows the lights of its shard.
+#
+
+import json
+import time
+import uuid
+import logging
+from HueState import hue_id
+
+LOGGER = logging.getLogger(__name__)
+
+DESCRIPTION = """<?xml version="1.0" encoding="UTF-8" ?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+<specVersion><major>1</major><minor>0</minor></specVersion>
+<URLBase>http://{ip}:{port}/</URLBase>
+<device>
+<deviceType>urn:schemas-upnp-org:device:Basic:1</deviceType>
+<friendlyName>{name}</friendlyName>
+<manufacturer>Royal Philips Electronics</manufacturer>
+<manufacturerURL>http://www.philips.com</manufacturerURL>
+<modelDescription>Philips hue Personal Wireless Lighting</modelDescription>
+<modelName>Philips hue bridge 2015</modelName>
+<modelNumber>BSB002</modelNumber>
+<modelURL>http://www.meethue.com</modelURL>
+<serialNumber>{serial}</serialNumber>
+<UDN>uuid:{uuid}</UDN>
+<presentationURL>index.html</presentationURL>
+</device>
+</root>
+"""
+
+# Hue API error types
+ERROR_UNAUTHORIZED   = 1
+ERROR_BAD_JSON       = 2
+ERROR_NOT_AVAILABLE  = 3
+ERROR_LINK_BUTTON    = 101
+ERROR_INTERNAL       = 901
+
+def new_bridge(mac):
+    return {
+        'mac':      ':'.join(mac[i:i+2] for i in range(0,12,2)),
+        'serial':   mac,
+        'bridgeid': (mac[:6] + 'fffe' + mac[6:]).upper(),
+        'uuid':     '2f402f80-da50-11e1-9b23-' + mac,
+    }
+
+def bridge_info(config,shard=0):
+    """
+    Returns the bridge identity saved in config['bridge'], it's created the
+    first time so clients always see the same bridge.  The other bridges
+    are made from it so they are always the same too.
+    """
+    if not 'bridge' in config:
+        config['bridge'] = new_bridge('{:012x}'.format(uuid.getnode()))
+    if shard == 0:
+        return config['bridge']
+    return new_bridge('{:012x}'.format((int(config['bridge']['serial'],16) + shard) % (1 << 48)))
+
+class HueApi():
+
+    def __init__(self,parent,host,port,shard=0):
+        self.parent = parent
+        self.host   = host
+        self.port   = int(port)
+        # The lights of this bridge are the ones where parent.state.shard(index) is shard
+        self.shard  = shard
+        self.bridge = bridge_info(parent.config,shard)
+        name = 'Philips hue ({})'.format(self.host) if shard == 0 else 'Philips hue ({}:{})'.format(self.host,self.port)
+        self.description_xml = DESCRIPTION.format(ip=self.host,port=self.port,name=name,serial=self.bridge['serial'],uuid=self.bridge['uuid'])
+
+    def on_bridge(self,index):
+        return self.parent.state.shard(index) == self.shard
+
+    def handle(self,method,path,body):
+        """
+        Returns (status,content_type,body) for a request
+        """
+        st = time.time()
+        recorder = self.parent.recorder
+        if recorder is not None:
+            recorder.request(self.shard,method,path,body)
+        path = path.split('?')[0]
+        ret = self.route(method,path,body)
+        self.parent.metrics.observe('hue_request_seconds',time.time() - st,(('method',method),('endpoint',self.endpoint(path))))
+        return ret
+
+    @staticmethod
+    def endpoint(path):
+        # The path without the user and ids, so there are only a few of them for the metrics.
+        parts = [part for part in path.split('/') if part != '']
+        if path in ['/description.xml', '/api', '/api/config']:
+            return path
+        if len(parts) < 2 or parts[0] != 'api':
+            return 'other'
+        if len(parts) == 2:
+            return '/api/{user}'
+        if parts[2] not in ['lights', 'groups', 'config', 'schedules', 'scenes', 'rules', 'sensors', 'resourcelinks']:
+            return 'other'
+        return '/api/{user}/' + '/'.join('{id}' if part.isdigit() else part for part in parts[2:5])
+
+    def route(self,method,path,body):
+        self.parent.hue_response()
+        if path == '/description.xml':
+            return (200,'text/xml',self.description_xml)
+        parts = [part for part in path.split('/') if part != '']
+        if len(parts) == 0 or parts[0] != 'api':
+            return (404,'text/plain','Not Found')
+        data = None
+        if method in ['POST','PUT']:
+            try:
+                data = json.loads(body) if body else {}
+            except ValueError:
+                return self.error(ERROR_BAD_JSON,path,'body contains invalid json')
+        if len(parts) == 1:
+            if method == 'POST':
+                return self.create_user(data)
+            return self.error(ERROR_UNAUTHORIZED,path,'unauthorized user')
+        if parts[1] == 'config' and len(parts) == 2:
+            return self.json(self.config(short=True))
+        # We accept any user name, parts[1]
+        parts = parts[2:]
+        if len(parts) == 0:
+            if method == 'POST':
+                return self.create_user(data)
+            return (200,'application/json','{{"lights":{},"groups":{},"config":{},"schedules":{{}},"scenes":{{}},"rules":{{}},"sensors":{{}},"resourcelinks":{{}}}}'.format(
+                self.parent.state.lights(self.shard),json.dumps(self.groups()),json.dumps(self.config())))
+        resource = parts[0]
+        if resource == 'lights':
+            return self.lights(method,path,parts[1:],data)
+        if resource == 'groups':
+            return self.groups_request(method,path,parts[1:],data)
+        if resource == 'config':
+            return self.json(self.config())
+        if method == 'GET' and len(parts) == 1:
+            # Resources we don't have, like schedules, scenes, rules, sensors
+            return self.json({})
+        return self.error(ERROR_NOT_AVAILABLE,path,'resource, {}, not available'.format(path))
+
+    #
+    # Lights
+    #
+    def lights(self,method,path,parts,data):
+        if len(parts) == 0:
+            if method == 'GET':
+                return (200,'application/json',self.parent.state.lights(self.shard))
+            return self.error(ERROR_NOT_AVAILABLE,path,'method, {}, not available'.format(method))
+        index = self.light_index(parts[0])
+        if index is None:
+            return self.error(ERROR_NOT_AVAILABLE,path,'resource, {}, not available'.format(path))
+        if len(parts) == 1 and method == 'GET':
+            return (200,'application/json',self.parent.state.light_json(index))
+        if len(parts) == 2 and parts[1] == 'state' and method == 'PUT':
+            return self.json(self.set_light(self.parent.pdevices[index],data,'/lights/{}/state'.format(parts[0])))
+        return self.error(ERROR_NOT_AVAILABLE,path,'resource, {}, not available'.format(path))
+
+    def light_index(self,lid):
+        try:
+            index = int(lid) - 1
+        except ValueError:
+            return None
+        if index < 0 or index >= len(self.parent.pdevices) or self.parent.pdevices[index] is False or not self.on_bridge(index):
+            return None
+        return index
+
+    @staticmethod
+    def set_light(device,data,prefix):
+        # Same as a hue_upnp PUT to a light, returns the Hue success list
+        # except a transitiontime, in 1/10 seconds, is used with a brightness.
+        ret = []
+        try:
+            transition = max(0,int(data.get('transitiontime',0)))
+        except (TypeError, ValueError):
+            transition = 0
+        if 'on' in data:
+            if data['on']:
+                if 'bri' in data:
+                    device.set_bri(int(data['bri']),transition)
+                else:
+                    device.set_on()
+            else:
+                device.set_off()
+        elif 'bri' in data:
+            device.set_bri(int(data['bri']),transition)
+        for key in ['on','bri','transitiontime']:
+            if key in data:
+                ret.append({'success': {'{}/{}'.format(prefix,key): data[key]}})
+        return ret
+
+    #
+    # Groups
+    #
+    def groups(self):
+        groups = dict()
+        for group in self.parent.groups:
+            if group is not False:
+                lights = self.group_lights(group)
+                if len(lights) > 0:
+                    groups[hue_id(group.index)] = group.json(lights)
+        return groups
+
+    def group_lights(self,group):
+        # The lights of the group on this bridge, a group is on every bridge that has one of its lights.
+        return [index for index in group.lights if self.on_bridge(index)]
+
+    def groups_request(self,method,path,parts,data):
+        if len(parts) == 0:
+            if method == 'GET':
+                return self.json(self.groups())
+            return self.error(ERROR_NOT_AVAILABLE,path,'method, {}, not available'.format(method))
+        if parts[0] == '0':
+            # The special group of all lights
+            if len(parts) == 1 and method == 'GET':
+                return self.json(self.all_lights())
+            if len(parts) == 2 and parts[1] == 'action' and method == 'PUT':
+                for index, device in enumerate(self.parent.pdevices):
+                    if device is not False and self.on_bridge(index):
+                        self.set_light(device,data,'')
+                return self.json(self.action_success('0',data))
+            return self.error(ERROR_NOT_AVAILABLE,path,'resource, {}, not available'.format(path))
+        group = self.group(parts[0])
+        if group is None:
+            return self.error(ERROR_NOT_AVAILABLE,path,'resource, {}, not available'.format(path))
+        if len(parts) == 1 and method == 'GET':
+            return self.json(group.json(self.group_lights(group)))
+        if len(parts) == 2 and parts[1] == 'action' and method == 'PUT':
+            if not group.set_action(data):
+                # The dispatcher queue is full, nothing was sent to the ISY
+                return self.error(ERROR_INTERNAL,path,'Internal error, ISY command queue is full')
+            return self.json(self.action_success(parts[0],data))
+        return self.error(ERROR_NOT_AVAILABLE,path,'resource, {}, not available'.format(path))
+
+    def group(self,gid):
+        try:
+            index = int(gid) - 1
+        except ValueError:
+            return None
+        if index < 0 or index >= len(self.parent.groups) or self.parent.groups[index] is False:
+            return None
+        group = self.parent.groups[index]
+        if len(self.group_lights(group)) == 0:
+            return None
+        return group
+
+    def all_lights(self):
+        lights = [index for index, device in enumerate(self.parent.pdevices) if device is not False and self.on_bridge(index)]
+        (any_on,all_on) = self.parent.state.any_all(lights)
+        return {
+            'name': 'Lightset 0', 'type': 'LightGroup',
+            'lights': [hue_id(index) for index in lights],
+            'action': {'on': any_on},
+            'state': {'any_on': any_on, 'all_on': all_on},
+        }
+
+    @staticmethod
+    def action_success(gid,data):
+        return [{'success': {'/groups/{}/action/{}'.format(gid,key): data[key]}} for key in ['on','bri'] if key in data]
+
+    #
+    # Config and users
+    #
+    def config(self,short=False):
+        config = {
+            'name':         'Philips hue',
+            'bridgeid':     self.bridge['bridgeid'],
+            'mac':          self.bridge['mac'],
+            'modelid':      'BSB002',
+            'swversion':    '1941132080',
+            'apiversion':   '1.41.0',
+            'datastoreversion': '98',
+            'factorynew':   False,
+            'replacesbridgeid': None,
+        }
+        if not short:
+            config.update({
+                'ipaddress':  self.host,
+                'dhcp':       True,
+                'linkbutton': self.parent.listening,
+                'UTC':        time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+                'localtime':  time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'whitelist':  {},
+                'zigbeechannel': 15,
+            })
+        return config
+
+    def create_user(self,data):
+        if not self.parent.listening:
+            LOGGER.warning('Create user rejected, not listening')
+            return self.error(ERROR_LINK_BUTTON,'/','link button not pressed')
+        username = uuid.uuid4().hex
+        LOGGER.warning('Created user {} for {}'.format(username,data))
+        return self.json([{'success': {'username': username}}])
+
+    @staticmethod
+    def json(data):
+        return (200,'application/json',json.dumps(data,separators=(',', ':')))
+
+    @staticmethod
+    def error(etype,address,description):
+        return (200,'application/json',json.dumps([{'error': {'type': etype, 'address': address, 'description': description}}]))
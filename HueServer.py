@@ -0,0 +1,115 @@
+#
+# The HueServer object.
+#
+# The native Hue server, used instead of hue_upnp when hue_server is native.
+# It serves the HueApi over HTTP and answers SSDP discovery while listening.
+# Each HueApi is a bridge with its own port, all of them are served here and
+# discovery for all of them is answered by one SSDPResponder.
+#
+
+import logging
+from threading import Thread,Lock
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+from SSDPResponder import SSDPResponder
+
+LOGGER = logging.getLogger(__name__)
+
+class HueHTTPServer(ThreadingHTTPServer):
+    # The default of 5 drops connections when a few clients connect at
+    # once, and each one waits a second to retry.
+    request_queue_size = 128
+    daemon_threads     = True
+
+class HueServer():
+
+    def __init__(self,apis,ssdp_rate=2.0):
+        self.apis     = apis
+        self.ssdp_rate = ssdp_rate
+        self.httpds   = []
+        self.ssdp     = None
+        # Set by stop, so a stop before run is not lost
+        self.stopped  = False
+        self.lock     = Lock()
+
+    @staticmethod
+    def make_server(api):
+        class HueRequestHandler(BaseHTTPRequestHandler):
+            # Keep connections open for clients that poll, the headers and body are
+            # separate writes so Nagle would hold the body for the delayed ACK.
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_PUT(self):
+                self.respond('PUT')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def respond(self,method):
+                length = int(self.headers.get('Content-Length',0))
+                body = self.rfile.read(length).decode('utf-8') if length > 0 else ''
+                (status,ctype,data) = api.handle(method,self.path,body)
+                data = data.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type',ctype)
+                self.send_header('Content-Length',str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self,format,*args):
+                LOGGER.debug('%s %s' % (self.address_string(),format % args))
+
+        return HueHTTPServer(('',api.port),HueRequestHandler)
+
+    def run(self,listen=False):
+        # Blocks until stop is called, like hue_upnp.run.  SSDP answers when
+        # the parent is listening so listen is not used here.
+        with self.lock:
+            if self.stopped:
+                LOGGER.info('Stopped before it was started')
+                return
+            httpds = []
+            try:
+                for api in self.apis:
+                    httpds.append(self.make_server(api))
+            except OSError:
+                # Free the ports already bound so a restart can use them
+                for httpd in httpds:
+                    httpd.server_close()
+                raise
+            self.httpds = httpds
+            self.ssdp = SSDPResponder(self.apis,self.ssdp_rate)
+            try:
+                self.ssdp.start()
+            except OSError as ex:
+                LOGGER.error('Unable to start SSDP, discovery will not work: {}'.format(ex), exc_info=True)
+                self.ssdp = None
+        # The first bridge is served by this thread
+        for api, httpd in list(zip(self.apis,self.httpds))[1:]:
+            thread = Thread(name='HueServer{}'.format(api.shard),target=httpd.serve_forever)
+            thread.daemon = True
+            thread.start()
+        for api in self.apis:
+            LOGGER.info('Serving Hue API on {}:{} bridge={} listen={}'.format(api.host,api.port,api.bridge['bridgeid'],listen))
+        self.httpds[0].serve_forever()
+        LOGGER.info('Stopped')
+
+    def stop(self):
+        # A shutdown before serve_forever returns once it starts
+        with self.lock:
+            self.stopped = True
+        if self.ssdp is not None:
+            self.ssdp.stop()
+        for httpd in self.httpds:
+            httpd.shutdown()
+            httpd.server_close()
+
+    # Same as hue_upnp, but the SSDPResponder checks the parent listening.
+    def start_listener(self):
+        pass
+
+    def stop_listener(self):
+        pass
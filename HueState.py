@@ -0,0 +1,168 @@
+#
+# The HueState object.
+#
+# A table of the current Hue state of each device keyed by the Hue index,
+# the same index as ISYHueEmu.pdevices.  It is only changed by ISY status
+# events and commands, so a Hue poll just reads the table.  The JSON for each
+# light and for the full lights list is kept serialized and only the entries
+# that changed since the last poll are rebuilt.  With more than one bridge
+# each one serves a shard of the lights, index % shards, and has its own list.
+#
+
+import json
+import logging
+from threading import Lock
+
+LOGGER = logging.getLogger(__name__)
+
+def hue_id(index):
+    # The Hue light id for a pdevices index
+    return str(index + 1)
+
+class HueState():
+
+    def __init__(self,shards=1):
+        self.lock    = Lock()
+        self.shards  = max(1,shards)
+        # index: {'device', 'name', 'type', 'on', 'bri', 'json', 'version'}
+        self.entries = dict()
+        self.dirty   = set()
+        # Incremented on every change, so polls between changes can be confirmed as cached.
+        self.version = 0
+        # The version of each shard, and the lights list of each shard as (version, json)
+        self.shard_versions = [0] * self.shards
+        self.lights_cache   = [(-1,'{}')] * self.shards
+        # Polls answered without rebuilding anything, and number of lights serialized.
+        self.hits    = 0
+        self.builds  = 0
+
+    def load(self,pdevices):
+        """
+        Sync the table with the devices list after a refresh, only devices
+        that were replaced are rebuilt.
+        """
+        with self.lock:
+            for index in [index for index in self.entries if index >= len(pdevices) or pdevices[index] is False]:
+                del self.entries[index]
+                self.dirty.discard(index)
+                self.changed(index)
+            for index, device in enumerate(pdevices):
+                if device is False:
+                    continue
+                entry = self.entries.get(index)
+                if entry is not None and entry['device'] is device:
+                    continue
+                self.changed(index)
+                self.entries[index] = {
+                    'device': device,
+                    'name':   device.name,
+                    'type':   device.type,
+                    'on':     device.on == "true",
+                    'bri':    int(device.bri),
+                    'json':   None,
+                    'version': self.version,
+                }
+                self.dirty.add(index)
+
+    def update(self,index,on,bri):
+        # Returns True if the state changed
+        with self.lock:
+            entry = self.entries.get(index)
+            if entry is None or (entry['on'] == on and entry['bri'] == bri):
+                return False
+            entry['on']  = on
+            entry['bri'] = bri
+            self.dirty.add(index)
+            self.changed(index)
+            entry['version'] = self.version
+            return True
+
+    def touch(self,index):
+        # Something besides on and bri changed, like the ISY node after a reconnect.
+        with self.lock:
+            entry = self.entries.get(index)
+            if entry is not None:
+                self.changed(index)
+                entry['version'] = self.version
+
+    def changed(self,index):
+        # Must be called with the lock held.
+        self.version += 1
+        self.shard_versions[self.shard(index)] += 1
+
+    def shard(self,index):
+        # The bridge that serves the light
+        return index % self.shards
+
+    def get_version(self,index):
+        # The version of the last change of an entry, None if there is no entry.
+        entry = self.entries.get(index)
+        return None if entry is None else entry['version']
+
+    def get(self,index):
+        # Returns (on,bri) in the hue_upnp handler format
+        entry = self.entries.get(index)
+        if entry is None:
+            return ("false",0)
+        return ("true" if entry['on'] else "false", entry['bri'])
+
+    def any_all(self,indexes):
+        # Returns (any_on,all_on) for the list of indexes
+        ons = [self.entries[index]['on'] for index in indexes if index in self.entries]
+        return (any(ons), len(ons) > 0 and all(ons))
+
+    def light_json(self,index):
+        with self.lock:
+            entry = self.entries.get(index)
+            if entry is None:
+                return None
+            if index in self.dirty:
+                self.build()
+            else:
+                self.hits += 1
+            return entry['json']
+
+    def lights(self,shard=0):
+        # The body for /api/<user>/lights of a bridge
+        with self.lock:
+            (version,lights_json) = self.lights_cache[shard]
+            if version == self.shard_versions[shard]:
+                self.hits += 1
+                return lights_json
+            self.build()
+            lights_json = '{' + ','.join(
+                '"{}":{}'.format(hue_id(index),self.entries[index]['json']) for index in sorted(self.entries) if self.shard(index) == shard
+            ) + '}'
+            self.lights_cache[shard] = (self.shard_versions[shard],lights_json)
+            return lights_json
+
+    def build(self):
+        # Serialize the dirty entries, must be called with the lock held.
+        for index in self.dirty:
+            entry = self.entries.get(index)
+            if entry is not None:
+                entry['json'] = json.dumps(self.light(index,entry), separators=(',', ':'))
+                self.builds += 1
+        self.dirty.clear()
+
+    @staticmethod
+    def light(index,entry):
+        state = {'on': entry['on'], 'alert': 'none', 'reachable': True}
+        if entry['type'] == "Dimmable light":
+            # Hue brightness is 1-254
+            state['bri'] = min(max(entry['bri'],1),254)
+            modelid = 'LWB014'
+        else:
+            modelid = 'LOM001'
+        return {
+            'state': state,
+            'type': entry['type'],
+            'name': entry['name'],
+            'modelid': modelid,
+            'manufacturername': 'Philips',
+            'uniqueid': '00:17:88:01:00:{:02x}:{:02x}:{:02x}-0b'.format((index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff),
+            'swversion': '1.0',
+        }
+
+    def stats(self):
+        return {'version': self.version, 'lights': len(self.entries), 'shards': self.shards, 'hits': self.hits, 'builds': self.builds}
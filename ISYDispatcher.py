@@ -0,0 +1,139 @@
+#
+# The ISYDispatcher object.
+#
+# Sends commands to the ISY from a small pool of worker threads so a slow ISY
+# doesn't hold up the Hue HTTP request.  Commands for the same device are run
+# one at a time in the order they were submitted, different devices run in
+# parallel.  The queue is bounded, and commands that waited longer than the
+# timeout are handled by the timeout policy:
+#   drop: Don't send it
+#   send: Send it anyway
+#
+
+import time
+import logging
+from collections import deque
+from threading import Thread,Condition
+
+LOGGER = logging.getLogger(__name__)
+
+class ISYDispatcher():
+
+    policies = ['drop', 'send']
+
+    def __init__(self,workers=4,max_queue=100,timeout=10.0,policy='drop'):
+        self.workers   = workers
+        self.max_queue = max_queue
+        self.timeout   = timeout
+        if policy not in self.policies:
+            LOGGER.error('Unknown timeout policy {}, using {}'.format(policy,self.policies[0]))
+            policy = self.policies[0]
+        self.policy    = policy
+        self.cond      = Condition()
+        # key: deque of commands waiting for that device
+        self.queues    = dict()
+        # Keys with commands waiting and not running, each key is only in here once.
+        self.ready     = deque()
+        self.depth     = 0
+        self.running   = False
+        self.threads   = []
+        # The last latencies, from submit to done, in seconds
+        self.latencies = deque(maxlen=500)
+        self.stats     = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'timeouts': 0}
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        for i in range(max(1,self.workers)):
+            thread = Thread(name='ISYDispatch{}'.format(i),target=self.worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        LOGGER.info('Started {} workers'.format(len(self.threads)))
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.queues.clear()
+            self.ready.clear()
+            self.depth = 0
+            self.cond.notify_all()
+        self.threads = []
+
+    def submit(self,key,func,args=(),done=None):
+        """
+        Queue func(*args) to run after all earlier commands for key.
+        done(ret) is called with the return value, False if it failed or was dropped.
+        Returns False if the queue is full.
+        """
+        with self.cond:
+            if self.depth >= self.max_queue:
+                self.stats['rejected'] += 1
+                LOGGER.error('Queue full ({}), rejected command for {}'.format(self.depth,key))
+                return False
+            self.stats['submitted'] += 1
+            queue = self.queues.get(key)
+            if queue is None:
+                # Not running or waiting, so it's ready
+                queue = self.queues[key] = deque()
+                self.ready.append(key)
+            queue.append((time.time(),func,args,done))
+            self.depth += 1
+            self.cond.notify()
+        return True
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while self.running and len(self.ready) == 0:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                key = self.ready.popleft()
+                (st,func,args,done) = self.queues[key].popleft()
+                self.depth -= 1
+            self.run(key,st,func,args,done)
+            with self.cond:
+                queue = self.queues.get(key)
+                if queue is not None:
+                    if len(queue) > 0:
+                        self.ready.append(key)
+                        self.cond.notify()
+                    else:
+                        del self.queues[key]
+
+    def run(self,key,st,func,args,done):
+        ret = False
+        if self.timeout > 0 and time.time() - st > self.timeout:
+            self.stats['timeouts'] += 1
+            LOGGER.warning('Command for {} waited {:.2f} seconds, policy={}'.format(key,time.time()-st,self.policy))
+            if self.policy == 'drop':
+                self.finish(key,st,ret,done)
+                return
+        try:
+            ret = func(*args)
+        except Exception as ex:
+            LOGGER.error('Command for {} failed: {}'.format(key,ex), exc_info=True)
+            ret = False
+        self.finish(key,st,ret,done)
+
+    def finish(self,key,st,ret,done):
+        self.latencies.append(time.time() - st)
+        self.stats['completed' if ret is not False else 'failed'] += 1
+        if done is not None:
+            try:
+                done(ret)
+            except Exception as ex:
+                LOGGER.error('Done callback for {} failed: {}'.format(key,ex), exc_info=True)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['depth'] = self.depth
+        latencies = sorted(self.latencies)
+        if len(latencies) > 0:
+            stats['latency_p50_ms'] = round(latencies[len(latencies) // 2] * 1000, 1)
+            stats['latency_p99_ms'] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 1)
+            stats['latency_max_ms'] = round(latencies[-1] * 1000, 1)
+        return stats
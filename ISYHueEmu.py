@@ -5,13 +5,36 @@
 # just this file to test, but haven't done that yet...
 #
 
-import json,os
 
 import sys
-import re
+import time
 import pyisy
 import shutil
+import sqlite3
+from xml.dom import minidom
 import logging
+import threading
+import weakref
+from datetime import datetime
+from threading import Thread,Lock,Event
+from concurrent.futures import ThreadPoolExecutor
+from NotesCache import NotesCache
+from HueState import HueState,hue_id
+from CommandCoalescer import CommandCoalescer
+from ISYDispatcher import ISYDispatcher
+from HueApi import HueApi
+from HueServer import HueServer
+from AsyncHueServer import AsyncHueServer
+from SSDPResponder import SSDPResponder
+from SceneState import SceneState
+from ISYSession import ISYSession
+from ISYSupervisor import ISYSupervisor
+from Metrics import Metrics,process_rss
+from DeviceLog import DeviceLog
+from DeviceRegistry import DeviceRegistry
+from DeviceClassifier import DeviceClassifier
+from Transition import Transition
+from Recorder import Recorder
 
 # Local version of hue-upnp which works with Python3
 sys.path.insert(0,"hue-upnp")
@@ -25,7 +48,51 @@ class ISYHueEmu():
 
     config_version = 1
 
-    def __init__(self,host,port,isy_host,isy_port,isy_user,isy_password):
+    # Optional tuning settings which can be passed in options, usually from
+    # the Custom Params.  The type of the default is the type of the option.
+    default_options = {
+        # Number of notes requests to run at once when finding spoken devices
+        'notes_workers': 8,
+        # Max seconds to spend checking cached notes in the background after a refresh
+        'notes_recheck_time': 120,
+        # Start the Hue server with the last known devices while connecting to the ISY
+        'warm_start': True,
+        # Seconds after a command to a device to combine more commands to it, only the last one is sent.  0 to disable.
+        'coalesce_window': 0.3,
+        # Threads sending commands to the ISY, and max commands waiting for them
+        'dispatch_workers': 4,
+        'dispatch_queue': 100,
+        # Seconds a command can wait to be sent, and what to do with it after that, drop or send
+        'cmd_timeout': 10.0,
+        'cmd_timeout_policy': 'drop',
+        # Serve Prometheus metrics on the port after the Hue port
+        'metrics': True,
+        # Max keep-alive connections to the ISY shared by all requests
+        'isy_connections': 4,
+        # Seconds to wait before trying to connect to the ISY again, doubled on each try up to the max
+        'reconnect_min_delay': 1.0,
+        'reconnect_max_delay': 60.0,
+        # The Hue server, hue_upnp, or native or asyncio which also support groups
+        'hue_server': 'hue_upnp',
+        # Threads for the asyncio hue_server to handle requests that change lights
+        'hue_workers': 4,
+        # Number of Hue bridges to spread the devices over, native or asyncio hue_server only
+        'bridges': 1,
+        # Discovery searches answered per second from each address, native or asyncio hue_server only
+        'ssdp_rate': 2.0,
+        # Hue types for devices the rules get wrong, node_def_id, node type or address=dimmable, onoff or scene, comma separated
+        'device_types': '',
+        # Status and command messages logged per device every 10 seconds, then only 1 of every log_sample.
+        'log_burst': 5,
+        'log_sample': 20,
+        # Seconds to record ISY events and Hue requests to the config folder for bench/replay.py, 0 to not record
+        'record': 0,
+        # Min seconds between updates of the Spoken Device Table, and max devices shown in it
+        'docs_interval': 30,
+        'docs_max_rows': 250,
+    }
+
+    def __init__(self,host,port,isy_host,isy_port,isy_user,isy_password,options=None):
         self.host         = host
         self.port         = port
         self.isy          = None # The pyisy.ISY object
@@ -34,11 +101,137 @@ class ISYHueEmu():
         self.isy_user     = isy_user
         self.isy_password = isy_password
         self.pdevices  = []
+        # Hue groups made from ISY scenes, only served by the native or asyncio hue_server
+        self.groups    = []
         self.lpfx = 'pyhue:'
         self.listening = False
-        self.config_file = 'config/config.json'
-        self.hue_upnp     = False
+        self.registry = DeviceRegistry('config/registry.db','config/config.json')
+        self.hue_server   = False
+        self.hue_thread   = None
+        # Held while starting or restarting the Hue server
+        self.hue_lock     = Lock()
+        self.refresh_lock = Lock()
+        # Set by stop, connect returns when it's set.
+        self.stopped      = Event()
+        # Used for the time to first Hue response startup metric.
+        self.start_time     = time.time()
+        self.first_response = None
+        # Seconds each startup phase took, in the order they ran
+        self.phases         = dict()
+        # Set by handlers when a device status changes so save_state knows to save.
+        self.state_changed  = False
+        # Result of the last reconcile after connecting
+        self.reconciled     = None
+        # Set while recording, see record
+        self.recorder       = None
+        self.options      = dict(ISYHueEmu.default_options)
+        if options is not None:
+            self.set_options(options)
+        # Hue state of each device in pdevices, this is what Hue polls read.
+        self.state     = HueState(self.bridges())
+        self.dispatcher = ISYDispatcher(
+            workers=self.options['dispatch_workers'],
+            max_queue=self.options['dispatch_queue'],
+            timeout=self.options['cmd_timeout'],
+            policy=self.options['cmd_timeout_policy'],
+        )
+        self.metrics = Metrics()
+        self.describe_metrics()
+        self.session = ISYSession(self.options['isy_connections'])
+        self.classifier = DeviceClassifier(self.options['device_types'])
+        self.supervisor = ISYSupervisor(self,self.options['reconnect_min_delay'],self.options['reconnect_max_delay'])
         self.load_config()
+        self.startup_phase('load',self.start_time)
+
+    def describe_metrics(self):
+        metrics = self.metrics
+        metrics.describe('hue_request_seconds','summary','Hue API requests by endpoint, native or asyncio hue_server only')
+        metrics.describe('isy_command_seconds','summary','ISY commands by device and command')
+        metrics.describe('isy_events_total','counter','ISY status events for spoken devices')
+        metrics.describe('isy_event_delay_seconds','summary','Time from the ISY event to the Hue state update')
+        metrics.describe('refresh_seconds','summary','Refresh by phase')
+        metrics.describe('hue_transitions_total','counter','Hue commands with a transitiontime by kind, fade or steps')
+        metrics.gauge('startup_phase_seconds','Seconds each phase of the last start took',
+            lambda: {(('phase',phase),): seconds for phase, seconds in self.phases.items()})
+        metrics.gauge('process_resident_bytes','Resident memory of the process',lambda: {(): process_rss()})
+        metrics.gauge('handlers_alive','Device handlers not garbage collected, more than hue_devices after a refresh is a leak',
+            lambda: {(): len(pyhue_isy_node_handler.instances)})
+        metrics.gauge('threads','Running threads',lambda: {(): threading.active_count()})
+        metrics.gauge('dispatch_depth','Commands waiting to be sent to the ISY',lambda: {(): self.dispatcher.depth})
+        metrics.gauge('dispatch_commands_total','Commands sent to the ISY by result',
+            lambda: {(('result',key),): value for key, value in self.dispatcher.stats.items()},'counter')
+        metrics.gauge('hue_devices','Spoken devices',lambda: {(): len([device for device in self.pdevices if device is not False])})
+        metrics.gauge('isy_connected','ISY connected',lambda: {(): 1 if self.isy_connected() else 0})
+        metrics.gauge('isy_reconnects','ISY reconnects',lambda: {(): self.supervisor.stats['reconnects']})
+        metrics.gauge('ssdp_packets_total','SSDP packets received by result, native or asyncio hue_server only',
+            lambda: {(('result',key),): value for key, value in self.ssdp_stats().items() if key not in ['received', 'searches', 'replies']},'counter')
+
+    def ssdp_stats(self):
+        ssdp = getattr(self.hue_server,'ssdp',None)
+        if not isinstance(ssdp,SSDPResponder):
+            return dict()
+        return dict(ssdp.stats)
+
+    def hue_server_stats(self):
+        if not isinstance(self.hue_server,AsyncHueServer):
+            return dict()
+        return self.hue_server.get_stats()
+
+    def summary(self):
+        """
+        A few values for the Controller drivers, the ISY command time is the
+        median of the recent commands in milliseconds.
+        """
+        cmd = self.metrics.get_quantile('isy_command_seconds',0.5)
+        return {
+            'events':     self.metrics.get_count('isy_events_total'),
+            'cmd_ms':     0 if cmd is None else int(round(cmd * 1000)),
+            'queue':      self.dispatcher.depth,
+            'reconnects': self.supervisor.stats['reconnects'],
+        }
+
+    def startup_phase(self,phase,st,now=None):
+        # Record the time since st for the startup phase, returns the time to start the next one.
+        if now is None:
+            now = time.time()
+        self.phases[phase] = round(now - st,3)
+        return now
+
+    def refresh_phase(self,phase,st):
+        # Record the time since st for the refresh phase, returns the time to start the next one.
+        now = time.time()
+        self.metrics.observe('refresh_seconds',now - st,(('phase',phase),))
+        return now
+
+    def set_options(self,options):
+        for key, value in options.items():
+            if not key in self.default_options:
+                LOGGER.warning('Ignoring unknown option {}={}'.format(key,value))
+                continue
+            default = self.default_options[key]
+            try:
+                if isinstance(default,bool):
+                    value = str(value).lower() in ['1', 'true', 'yes', 'on']
+                else:
+                    value = type(default)(value)
+            except ValueError:
+                LOGGER.error('Invalid value for option {}={}, using default {}'.format(key,value,default))
+                continue
+            LOGGER.info('option {}={}'.format(key,value))
+            self.options[key] = value
+
+    def bridges(self):
+        # Number of bridges, only the native or asyncio hue_server can have more than one.
+        if self.options['bridges'] > 1 and self.options['hue_server'] not in ['native', 'asyncio']:
+            LOGGER.error('bridges={} requires hue_server native or asyncio, using 1'.format(self.options['bridges']))
+            return 1
+        return max(1,self.options['bridges'])
+
+    def bridge_port(self,shard):
+        # The first bridge is on the Hue port, the others after the metrics port.
+        if shard == 0:
+            return int(self.port)
+        return int(self.port) + 1 + shard
 
     def isy_connected(self):
         if self.isy is None:
@@ -46,135 +239,480 @@ class ISYHueEmu():
         return self.isy.connected
 
     def connect(self,listen):
-        done = False
-        cnt  = 0
-        while (not done):
-            cnt += 1
-            LOGGER.debug('ISY connect try %d' % (cnt))
-            try:
-                self.isy = pyisy.ISY(self.isy_host, self.isy_port, self.isy_user, self.isy_password, False, 1.1, "")
-                done = True
-            except Exception as ex:
-                # Can any other exception happen?
-                template = "An exception of type {0} occured. Arguments:\n{1!r}"
-                message = template.format(type(ex).__name__, ex.args)
-                LOGGER.error(message, exc_info=True)
-            LOGGER.info(' ISY Connected: ' + str(self.isy.connected))
-            if not self.isy.connected:
-                if cnt == 10:
-                    LOGGER.error('Tried to connect 10 times, giving up')
-                    done = True
-                else:
-                    LOGGER.error('ISY not connected, will try again')
-
-        if not self.isy.connected:
+        """
+        Start everything, each phase is timed in phases.  Blocks until stop
+        is called or the Hue server stops, returns False when the ISY
+        connection failed.
+        """
+        st = time.time()
+        self.dispatcher.start()
+        if self.options['metrics']:
+            self.metrics.start(self.host,int(self.port) + 1)
+        # With warm start the Hue server answers from the saved devices until the ISY is ready.
+        warm = self.options['warm_start'] and self.load_snapshot()
+        if warm:
+            with self.hue_lock:
+                self.start_hue(listen)
+            st = self.startup_phase('warm_start',st)
+        isy = self.supervisor.open()
+        if isy is None:
+            if warm:
+                self.stop()
+            return False
+        st = self.startup_phase('isy_connect',st)
+        if not self.use_isy(isy):
+            if warm:
+                self.stop()
             return False
+        st = self.startup_phase('discover',st)
+        if self.options['record'] > 0:
+            self.record()
+        # From now on a lost ISY connection is made again without stopping the Hue server.
+        self.supervisor.start()
+        if warm:
+            LOGGER.info('Live devices took over {:.2f} seconds after start'.format(time.time()-self.start_time))
+        else:
+            with self.hue_lock:
+                self.start_hue(listen)
+            self.startup_phase('hue_start',st)
+        self.startup_phase('total',self.start_time)
+        LOGGER.info('Startup: {} phases={}'.format('warm' if warm else 'cold',self.phases))
+        self.stopped.wait()
+        return True
+
+    def restart_hue(self,port=None,options=None):
+        """
+        Start the Hue server again with a new port or options, the devices
+        and the ISY connection are kept.  The metrics move with the port.
+        """
+        st = time.time()
+        with self.hue_lock:
+            if options is not None:
+                self.set_options(options)
+            old = self.hue_server
+            # So run_hue knows this one was stopped on purpose
+            self.hue_server = False
+            if old is not False:
+                old.stop()
+                self.hue_thread.join(10)
+            if port is not None and port != self.port:
+                self.port = port
+                if self.metrics.httpd is not None:
+                    self.metrics.stop()
+                    self.metrics.start(self.host,int(self.port) + 1)
+            if old is False:
+                # Not started yet, connect starts it with the new port and options.
+                return False
+            self.start_hue(self.listening)
+        self.startup_phase('hue_restart',st)
+        LOGGER.info('Hue server restarted in {} seconds'.format(self.phases['hue_restart']))
+        return True
+
+    def set_isy(self,host,port,user,password):
+        # Connect to the ISY again with new params, the Hue server keeps answering with the current devices.
+        self.isy_host     = host
+        self.isy_port     = port
+        self.isy_user     = user
+        self.isy_password = password
+        self.supervisor.reconnect_now()
+
+    def open_isy(self):
+        # One try to connect to the ISY, returns the pyisy.ISY or None
+        try:
+            isy = pyisy.ISY(self.isy_host, self.isy_port, self.isy_user, self.isy_password, False, 1.1, "")
+        except Exception as ex:
+            # Can any other exception happen?
+            template = "An exception of type {0} occured. Arguments:\n{1!r}"
+            message = template.format(type(ex).__name__, ex.args)
+            LOGGER.error(message, exc_info=True)
+            return None
+        LOGGER.info(' ISY Connected: ' + str(isy.connected))
+        if not isy.connected:
+            return None
+        self.session.install(isy)
+        return isy
+
+    def use_isy(self,isy):
+        """
+        Switch to a new ISY connection, refresh keeps the current handlers
+        and moves them to the nodes of the new connection.
+        """
+        old = self.isy
+        self.isy = isy
+        if old is not None and old is not isy:
+            old.auto_reconnect = False
+            if old.auto_update:
+                old.auto_update = False
+        self.supervisor.watch(isy)
         # Now that we are all setup, we can accept device changes from the isy.
-        # FIXME: But this means from the time we connect till now, we can miss
-        # FIXME: device status changes, do we care?
+        # Changes from the time we connected till now are picked up by reconcile.
         self.isy.auto_update = True
         if not self.refresh():
             return False
+        self.reconcile()
+        return True
+
+    def reconcile(self):
+        """
+        Get the status of all nodes in one request and update the nodes that
+        changed since they were loaded, the handlers see it as a status event.
+        """
+        st = time.time()
+        xml = self.isy.conn.get_status()
+        if xml is None:
+            LOGGER.error('Unable to get ISY status, devices may be out of date until they change')
+            return False
+        try:
+            xmldoc = minidom.parseString(xml)
+        except Exception as ex:
+            LOGGER.error('Unable to parse ISY status: {}'.format(ex))
+            return False
+        handlers = [device for device in self.pdevices if isinstance(device,pyhue_isy_node_handler)]
+        before = [self.state.get(device.index) for device in handlers]
+        nodes = dict()
+        for (_, child) in self.isy.nodes:
+            if type(child).__name__ == 'Node':
+                nodes[child.address] = child
+        updated = 0
+        for feature in xmldoc.getElementsByTagName('node'):
+            node = nodes.get(feature.getAttribute('id'))
+            if node is None:
+                continue
+            for prop in feature.getElementsByTagName('property'):
+                if prop.getAttribute('id') == 'ST':
+                    # Same as the pyisy parser, unknown is value=" "
+                    value = prop.getAttribute('value').strip()
+                    try:
+                        value = int(value) if value != '' else pyisy.constants.ISY_VALUE_UNKNOWN
+                    except ValueError:
+                        LOGGER.warning('Reconcile: {} has a bad status {!r}, skipped'.format(node.address,value))
+                        break
+                    if value != node.status:
+                        updated += 1
+                        node.update(xmldoc=feature)
+                    break
+        drifted = len([1 for device, state in zip(handlers,before) if self.state.get(device.index) != state])
+        self.reconciled = {'nodes': updated, 'drifted': drifted, 'ms': round((time.time() - st) * 1000, 1)}
+        self.refresh_phase('reconcile',st)
+        LOGGER.info('Reconcile: {} nodes changed, {} devices drifted, took {} ms'.format(updated,drifted,self.reconciled['ms']))
+        return True
+
+    def start_hue(self,listen):
         #
-        # Now start up the hue_upnp...
+        # Now start up the hue server...
+        # It holds on to pdevices, so all changes to that list must be done in place.
         #
-        hueUpnp_config.devices = self.pdevices
-        hueUpnp_config.standard['IP']        = self.host
-        hueUpnp_config.standard['HTTP_PORT'] = int(self.port)
-        hueUpnp_config.standard['DEBUG']     = True
-        LOGGER.info('My config: IP={} HTTP_PORT={} DEBUG={}'.format(hueUpnp_config.standard['IP'],hueUpnp_config.standard['HTTP_PORT'],hueUpnp_config.standard['DEBUG']))
-        self.hue_upnp = hue_upnp(hueUpnp_config)
+        if self.options['hue_server'] == 'native':
+            LOGGER.info('Native Hue server: IP={} HTTP_PORT={} bridges={}'.format(self.host,self.port,self.state.shards))
+            self.hue_server = HueServer([HueApi(self,self.host,self.bridge_port(shard),shard) for shard in range(self.state.shards)],self.options['ssdp_rate'])
+        elif self.options['hue_server'] == 'asyncio':
+            LOGGER.info('asyncio Hue server: IP={} HTTP_PORT={} bridges={} workers={}'.format(self.host,self.port,self.state.shards,self.options['hue_workers']))
+            self.hue_server = AsyncHueServer([HueApi(self,self.host,self.bridge_port(shard),shard) for shard in range(self.state.shards)],self.options['ssdp_rate'],self.options['hue_workers'])
+        else:
+            if self.options['hue_server'] != 'hue_upnp':
+                LOGGER.error('Unknown hue_server {}, using hue_upnp'.format(self.options['hue_server']))
+            hueUpnp_config.devices = self.pdevices
+            hueUpnp_config.standard['IP']        = self.host
+            hueUpnp_config.standard['HTTP_PORT'] = int(self.port)
+            hueUpnp_config.standard['DEBUG']     = True
+            LOGGER.info('My config: IP={} HTTP_PORT={} DEBUG={}'.format(hueUpnp_config.standard['IP'],hueUpnp_config.standard['HTTP_PORT'],hueUpnp_config.standard['DEBUG']))
+            self.hue_server = hue_upnp(hueUpnp_config)
         self.listening = listen
-        self.hue_upnp.run(listen=listen)
+        self.hue_thread = Thread(name='HueServer',target=self.run_hue,args=(self.hue_server,listen))
+        self.hue_thread.daemon = True
+        self.hue_thread.start()
+
+    def run_hue(self,server,listen):
+        try:
+            server.run(listen=listen)
+        except Exception as ex:
+            LOGGER.error('Hue server crashed: {}'.format(ex), exc_info=True)
+        # Unless restart_hue stopped it, there is nothing left to do so let connect return.
+        if server is self.hue_server:
+            LOGGER.error('Hue server stopped')
+            self.stopped.set()
+
+    def load_snapshot(self):
+        """
+        Fill pdevices with the devices and last known state saved in the config
+        so the Hue server can answer before the ISY is connected.
+        """
+        devices = [item for item in self.registry.devices() if 'on' in item]
+        if len(devices) == 0:
+            LOGGER.info('No saved device state, warm start not possible')
+            return False
+        pdevices = [False] * (self.registry.max_index() + 1)
+        for item in devices:
+            pdevices[item['index']] = pyhue_snapshot_handler(self,item)
+        self.pdevices[:] = pdevices
+        self.state.load(self.pdevices)
+        LOGGER.info('Warm start with {} saved devices'.format(len(devices)))
+        return True
+
+    def hue_response(self):
+        if self.first_response is None:
+            self.first_response = time.time() - self.start_time
+            LOGGER.info('Startup: First Hue response {:.2f} seconds after start, isy_connected={}'.format(self.first_response,self.isy_connected()))
 
     def stop(self):
-        self.hue_upnp.stop()
-        if self.isy.connected and self.isy.auto_update:
-            isy.auto_update = False
+        self.supervisor.stop()
+        self.stop_recording()
+        self.save_state(force=True)
+        # So run_hue knows it was stopped on purpose
+        (server,self.hue_server) = (self.hue_server,False)
+        if server is not False:
+            server.stop()
+        self.dispatcher.stop()
+        self.metrics.stop()
+        self.registry.close()
+        for device in self.pdevices:
+            if isinstance(device,pyhue_isy_node_handler):
+                device.release()
+        if self.isy is not None and self.isy.connected and self.isy.auto_update:
+            self.isy.auto_update = False
+        self.stopped.set()
+
+    def stats(self):
+        # Counters from the parts that keep them, logged by the Controller
+        commands = {'received': 0, 'coalesced': 0, 'dropped': 0, 'sent': 0}
+        for device in self.pdevices:
+            if isinstance(device,pyhue_isy_node_handler):
+                for key, value in device.coalescer.stats.items():
+                    commands[key] += value
+        return {'commands': commands, 'dispatch': self.dispatcher.get_stats(), 'state': self.state.stats(), 'registry': self.registry.stats(), 'classifier': self.classifier.get_stats(), 'memory': self.memory_report(), 'isy': self.session.get_stats(), 'isy_connect': self.supervisor.stats, 'reconcile': self.reconciled, 'ssdp': self.ssdp_stats(), 'hue_server': self.hue_server_stats(), 'startup': self.phases, 'recorder': None if self.recorder is None else self.recorder.get_stats(), 'notes': {'cached': self.notes_cache.hits, 'fetched': self.notes_cache.fetched}}
+
+    def memory_report(self,devices=False):
+        """
+        The process RSS and the handlers still alive, which should stay the
+        same after refreshes and reconnects.  With devices the bytes used by
+        each device handler, largest first.
+        """
+        handlers = [device for device in self.pdevices if isinstance(device,pyhue_isy_node_handler)]
+        sizes = [(device.name,device.memory()) for device in handlers]
+        report = {
+            'rss_kb':         process_rss() // 1024,
+            'handlers':       len(handlers),
+            'handlers_alive': len(pyhue_isy_node_handler.instances),
+            'handler_bytes':  sum(size for name, size in sizes),
+        }
+        if devices:
+            report['devices'] = sorted(sizes,key=lambda item: item[1],reverse=True)
+        return report
+
+    def record(self):
+        """
+        Start recording for the record option seconds, a recording that is
+        running is stopped first.  The file is config/record-<time>.jsonl.gz
+        """
+        self.stop_recording()
+        if self.options['record'] <= 0 or self.isy is None:
+            return None
+        path = 'config/record-{}.jsonl.gz'.format(time.strftime('%Y%m%d-%H%M%S'))
+        try:
+            self.recorder = Recorder(path,self.recording_layout(),self.options['record'],self.recording_states)
+        except OSError as ex:
+            LOGGER.error('Unable to record to {}: {}'.format(path,ex))
+        return self.recorder
+
+    def stop_recording(self):
+        (recorder,self.recorder) = (self.recorder,None)
+        if recorder is not None:
+            recorder.close()
+
+    def recording_layout(self):
+        # What bench/replay.py needs to make a FakeISY like this ISY, and the Hue ids of the devices.
+        handlers = [device for device in self.pdevices if isinstance(device,pyhue_isy_node_handler) and device.node is not None]
+        spoken   = {device.id: device.name for device in handlers}
+        scenes   = [device.node if device.is_scene else device.scene for device in handlers]
+        scenes  += [group.scene for group in self.groups if group is not False]
+        nodes    = dict()
+        groups   = dict()
+        for scene in scenes:
+            if scene is False or scene is None or scene.address in groups:
+                continue
+            groups[scene.address] = {'name': scene.name, 'members': list(scene.members), 'controllers': list(scene.controllers), 'spoken': spoken.get(scene.address)}
+            nodes.update({address: None for address in scene.members})
+        nodes.update({device.id: None for device in handlers if not device.is_scene})
+        for address in list(nodes):
+            try:
+                node = self.isy.nodes[address]
+            except KeyError:
+                del nodes[address]
+                continue
+            nodes[address] = {'name': node.name, 'node_def_id': getattr(node,'node_def_id',None), 'type': getattr(node,'type',None),
+                'status': node.status, 'spoken': spoken.get(address)}
+        return {
+            'options': {key: self.options[key] for key in ['hue_server', 'bridges', 'coalesce_window', 'device_types']},
+            'nodes':   nodes,
+            'scenes':  groups,
+            'devices': {device.id: device.index for device in handlers},
+            'groups':  {group.id: group.index for group in self.groups if group is not False},
+        }
+
+    def recording_states(self):
+        # The Hue (on,bri) of each device by address, the last line of a recording.
+        states = dict()
+        for device in self.pdevices:
+            if isinstance(device,pyhue_isy_node_handler):
+                (on,bri) = self.state.get(device.index)
+                states[device.id] = [on == "true", int(bri)]
+        return states
+
+    def log_memory_report(self):
+        # Log the memory report with each device, as warnings so they show at any log level.
+        report = self.memory_report(devices=True)
+        for (name,size) in report.pop('devices'):
+            LOGGER.warning('memory_report: {} {} bytes'.format(name,size))
+        LOGGER.warning('memory_report: {}'.format(report))
+
+    def dump_log(self):
+        # Log the recent messages kept by each device, as warnings so they show at any log level.
+        for device in self.pdevices:
+            if isinstance(device,pyhue_isy_node_handler):
+                for line in device.log.dump():
+                    LOGGER.warning('dump_log: {}'.format(line))
+
+    def save_state(self,force=False):
+        # Save the device status for the next warm start, only when something changed.
+        if self.isy_connected() and (force or self.state_changed):
+            self.state_changed = False
+            # Not while a refresh is changing the devices
+            with self.refresh_lock:
+                self.save_config()
 
     def start_listener(self):
-        if self.hue_upnp is not False:
-            self.hue_upnp.start_listener()
+        self.listening = True
+        if self.hue_server is not False:
+            self.hue_server.start_listener()
 
     def stop_listener(self):
-        if self.hue_upnp is not False:
-            self.hue_upnp.stop_listener()
+        self.listening = False
+        if self.hue_server is not False:
+            self.hue_server.stop_listener()
 
     def save_config(self):
-        LOGGER.info(self.config_file)
-        self.config['version'] = 1
-        # Only used for debugging
-        self.config['devices_hue'] = []
-        self.config_info = []
-        for i, device in enumerate(self.pdevices):
-            # Only used for debug
-            if device is False:
-                self.config['devices_hue'].append(device)
-                self.config_info.append('device index={} empty'.format(i))
-            else:
-                self.config['devices_hue'].append({'name': device.name, 'id': device.id, 'index': i })
-                self.config_info.append('device index={} id={} name={}'.format(i,device.id,device.name))
-        LOGGER.info("saving config.tmp")
-        with open("config.tmp", 'w') as outfile:
-            json.dump(self.config, outfile, ensure_ascii=False, indent=4, sort_keys=True)
-        LOGGER.info("saving {}".format(self.config_file))
-        os.rename("config.tmp",self.config_file)
+        # Last known state and type for warm start, only the devices that changed are written.
+        for item in self.registry.devices():
+            if item['index'] < len(self.pdevices):
+                device = self.pdevices[item['index']]
+                if isinstance(device,pyhue_isy_node_handler):
+                    item['type'] = device.type
+                    item['on']   = device.on
+                    item['bri']  = device.bri
+        try:
+            writes = self.registry.save(self.notes_cache.copy())
+        except sqlite3.Error as ex:
+            LOGGER.error('Unable to save {}: {}'.format(self.registry.path,ex))
+            return False
+        LOGGER.info('Saved {} changes to {}'.format(writes,self.registry.path))
+        return True
 
     def load_config(self):
-        if os.path.exists(self.config_file):
-            LOGGER.info(self.config_file)
-            with open(self.config_file, "r") as ifile:
-                self.config = json.load(ifile)
-        else:
-            LOGGER.info('No config, using default')
-            self.config = { 'devices': [], 'config': hueUpnp_config.standard, 'version': 1 }
+        try:
+            self.registry.open()
+        except sqlite3.Error as ex:
+            LOGGER.error('Unable to open {}, starting with no saved devices: {}'.format(self.registry.path,ex))
+        self.config = self.registry.config
+        self.notes_cache = NotesCache(self,self.registry.notes)
 
     def refresh(self):
+        # Can be called from the Controller and the NotesCache recheck at the same time.
+        with self.refresh_lock:
+            return self._refresh()
+
+    def _refresh(self):
         errors = 0
+        st = time.time()
         # Build device list for emulator full of False which are ignored by hue-Upnp
         # This is so remvoed devices are just blanks
-        max = -1
-        for item in self.config['devices']:
-            if item['index'] > max:
-                max = item['index']
-        LOGGER.info('max index = {}'.format(max))
-        self.pdevices = []
+        max = self.registry.max_index()
+        pdevices = []
         for i in range(0,max+1):
-            self.pdevices.append(False)
-        LOGGER.info('max index = {}, len pdevices = {}'.format(max,len(self.pdevices)))
+            pdevices.append(False)
+        LOGGER.info('max index = {}, len pdevices = {}'.format(max,len(pdevices)))
+        # The current handlers, only new or changed nodes get a new handler.
+        current = dict()
+        for device in self.pdevices:
+            if isinstance(device,pyhue_isy_node_handler):
+                current[device.id] = device
+        cnt = {'kept': 0, 'rebound': 0, 'added': 0, 'changed': 0, 'removed': 0}
         found_nodes = False
+        # Gather the nodes first so all the notes can be fetched at once.
+        cnodes = []
+        # The first scene each node is a controller of, same as node.get_groups(responder=False)[0]
+        # without walking all the nodes for each one.
+        controls = dict()
         for (_, child) in self.isy.nodes:
             ctype = type(child).__name__
-            LOGGER.info("add_spoken_device: checking {} type={} ctype={}".format(child,type(child),ctype))
+            LOGGER.debug("add_spoken_device: checking %s ctype=%s",child,ctype)
             found_nodes = True
             if ctype in ['Node', 'Group']:
-                #LOGGER.info(child)
-                mnode = child
-                spoken = mnode.spoken
-                if spoken is not None:
-                    # TODO: Should this be a comma seperatd list of which echo will respond?
-                    # TODO: Or should that be part of notes?
-                    if spoken == '1':
-                        spoken = mnode.name
-                    LOGGER.info("add_spoken_device: name=" + mnode.name + ", spoken=" + str(spoken))
-                    cnode = False
-                    if ctype == "Node":
-                        # Is it a controller of a scene?
-                        cgroup = mnode.get_groups(responder=False)
-                        if len(cgroup) > 0:
-                            cnode = self.isy.nodes[cgroup[0]]
-                            LOGGER.info(" is a scene controller of " + str(cgroup[0]) + '=' + str(cnode) + ' "' + cnode.name + '"')
-                    else:
-                        cnode = mnode
-                        #if len(mnode.controllers) > 0:
-                        # FIXME: Problem with this is it may pick the wrong controller
-                        # FIXME: If a remotelink and kpl are both controllers may pick the remotelink :(
-                        #        mnode = self.isy.nodes[mnode.controllers[0]]
-                    self.insert_device(pyhue_isy_node_handler(self,spoken,mnode,cnode))
+                cnodes.append(child)
+            if ctype == 'Group':
+                for address in child.controllers:
+                    controls.setdefault(address,child)
+        st = self.refresh_phase('nodes',st)
+        # Returned in the same order as cnodes, so the device order is the same
+        # as checking them one at a time.
+        spokens = self.get_spokens(cnodes)
+        st = self.refresh_phase('notes',st)
+        for mnode, spoken in zip(cnodes, spokens):
+            if spoken is not None:
+                ctype = type(mnode).__name__
+                # TODO: Should this be a comma seperatd list of which echo will respond?
+                # TODO: Or should that be part of notes?
+                if spoken == '1':
+                    spoken = mnode.name
+                LOGGER.info("add_spoken_device: name=" + mnode.name + ", spoken=" + str(spoken))
+                cnode = False
+                if ctype == "Node":
+                    # Is it a controller of a scene?
+                    cnode = controls.get(mnode.address,False)
+                    if cnode is not False:
+                        LOGGER.info(" is a scene controller of " + str(cnode.address) + '=' + str(cnode) + ' "' + cnode.name + '"')
+                else:
+                    cnode = mnode
+                    #if len(mnode.controllers) > 0:
+                    # FIXME: Problem with this is it may pick the wrong controller
+                    # FIXME: If a remotelink and kpl are both controllers may pick the remotelink :(
+                    #        mnode = self.isy.nodes[mnode.controllers[0]]
+                device = current.pop(mnode.address,None)
+                if device is None:
+                    cnt['added'] += 1
+                    device = pyhue_isy_node_handler(self,spoken,mnode,cnode)
+                elif device.matches(spoken,mnode,cnode):
+                    cnt['kept'] += 1
+                elif device.same_device(spoken,mnode,cnode):
+                    # The same device from a new ISY connection
+                    cnt['rebound'] += 1
+                    device.rebind(mnode,cnode)
+                else:
+                    cnt['changed'] += 1
+                    device.release()
+                    device = pyhue_isy_node_handler(self,spoken,mnode,cnode)
+                self.insert_device(pdevices,device)
         if not found_nodes:
             LOGGER.error("No nodes with spoken found, could have been an ISY connection error?")
             return;
+        # What's left are no longer spoken, or not on the ISY anymore.
+        for device in current.values():
+            LOGGER.info('Removing device name={} id={}'.format(device.name,device.id))
+            cnt['removed'] += 1
+            device.release()
+        LOGGER.info('Refresh devices: {}'.format(cnt))
+        # Replace in place since hue_upnp holds on to this list, this is also
+        # when live devices take over from a warm start.
+        snapshot = [device for device in self.pdevices if isinstance(device,pyhue_snapshot_handler)]
+        self.pdevices[:] = pdevices
+        self.state.load(self.pdevices)
+        LOGGER.info('Hue state: {}'.format(self.state.stats()))
+        st = self.refresh_phase('handlers',st)
+        self.refresh_groups(cnodes)
+        st = self.refresh_phase('groups',st)
+        for device in snapshot:
+            device.takeover()
         self.save_config()
+        self.refresh_phase('save',st)
 
 
         #for var in self.isy.variables.children:
@@ -190,35 +728,82 @@ class ISYHueEmu():
             raise ValueError("See Log")
         return True
 
+    def refresh_groups(self,nodes):
+        """
+        Make a Hue group for each ISY scene that contains spoken devices, with
+        those devices as the lights.  The name is the spoken if the scene is a
+        spoken device.  Indexes are saved in the config like devices so they don't change.
+        """
+        # The index of each spoken device by address
+        lights = dict()
+        names  = dict()
+        for index, device in enumerate(self.pdevices):
+            if isinstance(device,pyhue_isy_node_handler):
+                lights[device.id] = index
+                if device.is_scene:
+                    names[device.id] = device.name
+        scenes = dict()
+        for node in nodes:
+            if type(node).__name__ == 'Group':
+                scenes[node.address] = (node, names.get(node.address,node.name))
+        items = self.registry.groups
+        groups = [False] * len(items)
+        for address, (scene, name) in scenes.items():
+            members = [lights[member] for member in scene.members if member in lights]
+            if len(members) == 0:
+                LOGGER.debug('Scene {} has no spoken devices'.format(scene))
+                continue
+            item = items.get(address)
+            if item is None:
+                item = self.registry.add_group(address,name)
+                groups.append(False)
+            item['name'] = name
+            groups[item['index']] = pyhue_isy_scene_group(self,name,scene,members,item['index'])
+        self.groups[:] = groups
+        LOGGER.info('Found {} scenes with spoken devices'.format(len([group for group in groups if group is not False])))
+
+    def get_spokens(self,nodes):
+        """
+        Return the Spoken property for each of the nodes, in the same order.
+        Only the nodes that are not in the notes cache are requested from the ISY.
+        """
+        return self.notes_cache.get_spokens(nodes,self.fetch_spokens)
+
+    def fetch_spokens(self,nodes):
+        """
+        Each one is a seperate notes request to the ISY, so they are run in a
+        pool of notes_workers threads instead of one at a time.
+        """
+        if len(nodes) == 0:
+            return []
+        st = time.time()
+        workers = max(1,self.options['notes_workers'])
+        with ThreadPoolExecutor(max_workers=workers,thread_name_prefix='ISYNotes') as executor:
+            spokens = list(executor.map(NotesCache.fetch,nodes))
+        LOGGER.info('Fetched notes for {} nodes with {} workers in {:.2f} seconds'.format(len(nodes),workers,time.time()-st))
+        return spokens
+
     def in_config(self,device):
-        # Config devices saves the id and name so we can keep the same index.
-        for item in self.config['devices']:
-            if device.id == item['id']:
-                LOGGER.info('Found id in config {}'.format(item))
-                return item
-        # Didn't find by id, try by name
-        for item in self.config['devices']:
-            if device.name == item['name']:
-                LOGGER.info('Found name in config {}'.format(item))
-                return item
-        return False
-
-    def insert_device(self,device):
-        # TODO: See if we have an id with this name and use it
-	    # TODO: This is so ID's never change.
+        # The registry saves the id and name so we can keep the same index.
+        item = self.registry.find(device.id,device.name)
+        if item is None:
+            return False
+        LOGGER.info('Found in config {}'.format(item))
+        return item
+
+    def insert_device(self,pdevices,device):
+        # The index of a device never changes, unless it's removed from the registry.
         fdev = self.in_config(device)
         if fdev is False:
-            LOGGER.info('Appending device name={} id={} index={}'.format(device.name,device.id,len(self.pdevices)))
-            self.config['devices'].append({'name': device.name, 'id': device.id, 'index': len(self.pdevices), 'type': device.type })
-            self.pdevices.append(device)
+            LOGGER.info('Appending device name={} id={} index={}'.format(device.name,device.id,len(pdevices)))
+            fdev = self.registry.add(device.id,device.name,device.type,len(pdevices))
+            device.index = fdev['index']
+            pdevices.append(device)
         else:
-            #This shouldn't happen now that we initialize the list with False
-            #for value in variable}if len(self.pdevices) <= fdev['index']:
-            #    LOGGER.info('Inserting device name={} id={} index={}'.format(device.name,device.id,fdev['index']))
-            #    self.pdevices.insert(fdev['index'],device)
-            #else:
             LOGGER.info('Setting   device name={} type={} id={} index={} '.format(device.name,device.type,device.id,fdev['index']))
-            self.pdevices[fdev['index']] = device
+            device.index = fdev['index']
+            pdevices[fdev['index']] = device
+        self.registry.assign(fdev,device.id,device.name)
 
 
     def xxx_add_device(self,config):
@@ -244,12 +829,30 @@ class ISYHueEmu():
         else:
             raise ValueError("Unknown PyHue device type " + config['type'])
 
+def sizeof(*objs):
+    # Shallow size of the objects and their dict, None is not counted
+    size = 0
+    for obj in objs:
+        if obj is not None:
+            size += sys.getsizeof(obj)
+            if hasattr(obj,'__dict__'):
+                size += sys.getsizeof(obj.__dict__)
+    return size
+
 #
 # This is the hue_upnp object for an ISY device
 #
 class pyhue_isy_node_handler(hue_upnp_super_handler):
         global CONFIG
 
+        # The state is kept in slots instead of a dict for each handler, and the
+        # parent and pyisy objects are weak references so a handler doesn't keep
+        # an old ISY connection alive.
+        __slots__ = ['_parent', '_node', '_scene', 'name', 'id', 'is_scene', 'rule', 'type', 'dimmable', 'set_scene',
+                     'xy', 'ct', 'bri', 'on', 'index', 'log', 'coalescer', 'listener', 'scene_state', 'transition']
+        # All handlers that have not been garbage collected, for the memory report
+        instances = weakref.WeakSet()
+
         def __init__(self, parent, name, node, scene):
                 self.name    = name
                 self.parent  = parent
@@ -257,101 +860,292 @@ class pyhue_isy_node_handler(hue_upnp_super_handler):
                 # Used to look for device in list in case name changes.
                 self.id      = node.address
                 self.scene   = scene
-                self.dimmable = False
-                self.is_scene = False
-                self.set_scene = False
-                # Matchs KPL buttons except the main one, since that is dimmable and the others are not.
-                kpl_sub = re.compile('^[0-9A-F]{2}\s[0-9A-F]{2}\s[0-9A-F]{2}\s[2-9]+')
-                # By default we control the main node, which can be a scene
-                self.control_device = self.node
-                if node.protocol == pyisy.constants.PROTO_GROUP:
-                    LOGGER.info('name=%s node=%s scene=%s protocol=%s' % (self.name, self.node, self.scene, node.protocol))
-                    # TODO: Should this be a Hue Scene?
-                    # We assume scenes are dimmable, although we don't handle this properly yet...
-                    self.type = "Dimmable light"
-                    self.is_scene = True
-                    self.set_scene = True
-                else:
-                    LOGGER.info('name=%s node=%s node.type=%s node.dimmable=%s scene=%s protocol=%s' % (self.name, self.node, self.node.type, self.node.dimmable, self.scene, node.protocol))
-                    if node.dimmable is True:
-                        # Not All KPL buttons!
-                        match = kpl_sub.match(self.node.address)
-                        LOGGER.info('kpl_sub {} match={}'.format(self.node.address,match))
-                        if match is None:
-                            self.type = "Dimmable light"
-                            self.dimmable = True
-                        else:
-                            self.type = "On/off light"
-                    else:
-                        self.type = "On/off light"
-                    # These node types can not be directly controled, so control the scene
-                    # nodeDefId="KeypadButton_ADV"
-                    #if node.type == '1.66.69.0':
-                    #if node.node_def_id == "KeypadButton_ADV" or node.node_def_id == "RelayLampSwitch_ADV":
-                    #    self.control_device = self.scene
-                    #    self.set_scene = True
-                    #    self.type = "On/off Light"
+                # TODO: Should a scene be a Hue Scene?
+                self.is_scene = node.protocol == pyisy.constants.PROTO_GROUP
+                # The Hue type, see DeviceClassifier for the rules and the device_types option to add more.
+                self.rule = parent.classifier.classify(node)
+                self.type      = self.rule['type']
+                self.dimmable  = self.rule['dimmable']
+                self.set_scene = self.rule['set_scene']
+                self.transition = None
                 self.xy      = False
                 self.ct      = False
                 self.bri     = 0
                 self.on      = "false"
-                node.status_events.subscribe(self.get_all_changed)
-                LOGGER.info('name=%s node=%s scene=%s type=%s dimmable=%s' % (self.name, self.node, self.scene, self.type, self.dimmable))
+                # Set when added to pdevices, it's the key for the parent HueState
+                self.index   = None
+                self.log     = DeviceLog(LOGGER,name,parent.options['log_burst'],parent.options['log_sample'])
+                self.coalescer = CommandCoalescer(name,parent.options['coalesce_window'],self.send,self.isy_state)
+                self.listener = None
+                self.scene_state = None
+                self.subscribe()
+                pyhue_isy_node_handler.instances.add(self)
+                LOGGER.info('name=%s node=%s scene=%s type=%s dimmable=%s rule=%s' % (self.name, self.node, self.scene, self.type, self.dimmable, self.rule['rule']))
                 super(pyhue_isy_node_handler,self).__init__(name)
+                self.update_status()
+
+        @property
+        def parent(self):
+                return self._parent()
+
+        @parent.setter
+        def parent(self, parent):
+                self._parent = weakref.ref(parent)
+
+        @property
+        def node(self):
+                # None when the pyisy connection it's from is gone
+                return self._node()
+
+        @node.setter
+        def node(self, node):
+                self._node = weakref.ref(node)
+
+        @property
+        def scene(self):
+                # The scene it's a controller of, or False
+                return False if self._scene is False else self._scene()
+
+        @scene.setter
+        def scene(self, scene):
+                self._scene = False if scene is False else weakref.ref(scene)
+
+        @property
+        def control_device(self):
+                # By default we control the main node, which can be a scene
+                if self.set_scene and not self.is_scene and self.scene is not False:
+                    return self.scene
+                return self.node
+
+        def memory(self):
+                # Bytes used by the handler and what only it uses, not the pyisy objects
+                return sizeof(self,self.log,self.log.recent,*self.log.recent) + sizeof(self.coalescer) + sizeof(self.scene_state)
+
+        def matches(self, name, node, scene):
+                # True when refresh would create the same handler.
+                return self.name == name and self.node is node and self.scene is scene
+
+        def same_device(self, name, node, scene):
+                # True when it's the same device, but the node objects are from another ISY connection.
+                if self.name != name or self.id != node.address:
+                    return False
+                if self.scene is False or scene is False:
+                    return self.scene is scene
+                return self.scene.address == scene.address
+
+        def rebind(self, node, scene):
+                # Move to the nodes of a new ISY connection, pending commands are kept.
+                LOGGER.info('%s rebind to new connection' % (self.name))
+                self.unsubscribe()
+                self.node    = node
+                self.scene   = scene
+                self.subscribe()
+                self.update_status()
+                self.parent.state.touch(self.index)
+
+        def subscribe(self):
+                # Must be unsubscribed when this handler is replaced so events only go to the current one.
+                self.listener = self.node.status_events.subscribe(self.get_all_changed)
+                # The brightness of a scene is kept from the status of its members
+                if self.is_scene:
+                    self.scene_state = SceneState(self.node,self.parent.isy.nodes,self.scene_changed)
+
+        def unsubscribe(self):
+                if self.listener is not None:
+                    LOGGER.debug('%s unsubscribe' % (self.name))
+                    self.listener.unsubscribe()
+                    self.listener = None
+                if self.scene_state is not None:
+                    self.scene_state.release()
+                    self.scene_state = None
+
+        def release(self):
+                # Stop listening for node status changes when this handler is no longer used.
+                self.unsubscribe()
+                self.cancel_transition()
+                self.coalescer.cancel()
 
         def get_all_changed(self,e):
-                LOGGER.info('%s e=%s' % (self.name, str(e)));
-                self.get_all()
+                self.log.info('e=%s',e)
+                node = self.node
+                if node is None:
+                    # A late event from a connection that is gone
+                    return
+                self.parent.state_changed = True
+                recorder = self.parent.recorder
+                if recorder is not None:
+                    recorder.event(self.id,node.status)
+                if self.in_transition():
+                    # Hue already has the target, don't report the levels on the way
+                    self.log.debug('status=%s ignored during transition',node.status)
+                else:
+                    self.update_status()
+                metrics = self.parent.metrics
+                metrics.inc('isy_events_total')
+                changed = getattr(node,'last_changed',None)
+                if isinstance(changed,datetime):
+                    metrics.observe('isy_event_delay_seconds',max(0,(datetime.now() - changed).total_seconds()))
+
+        def scene_changed(self,address,level):
+                # A member of the scene changed level
+                self.parent.state_changed = True
+                recorder = self.parent.recorder
+                if recorder is not None:
+                    recorder.event(address,level)
+                self.update_status()
 
         def get_all(self):
-                LOGGER.info('%s status=%s' % (self.name, self.node.status))
+                # Called by hue_upnp to answer a Hue request, the state is
+                # already known from the status events.
+                self.parent.hue_response()
+                (self.on,self.bri) = self.parent.state.get(self.index)
+
+        def update_status(self):
+                node = self.node
+                levels = self.scene_state is not None and len(self.scene_state.levels) > 0
+                if node is None and not levels:
+                    # The connection is gone, keep the last state until it's rebound
+                    self.log.debug('no node, status not updated')
+                    return
                 # Set all the defaults
                 super(pyhue_isy_node_handler,self).get_all()
                 # node.status will be 0-255
-                if self.node.status == pyisy.constants.ISY_VALUE_UNKNOWN:
-                    LOGGER.warning('%s status=%s, changing to 0' % (self.name, self.node.status));
+                if levels:
+                    # The group status is on when any member is, use the mean of the members.
+                    self.bri = self.scene_state.bri()
+                elif node.status == pyisy.constants.ISY_VALUE_UNKNOWN:
+                    self.log.log(logging.WARNING,'status=%s, changing to 0',node.status)
                     self.bri = 0
                 else:
-                    # TODO: if it's a scene, calculate the on level?
-                    self.bri = int(self.node.status)
+                    self.bri = int(node.status)
+                self.set_status(self.bri)
+                self.log.debug('status=%s on=%s bri=%s',None if node is None else node.status,self.on,self.bri)
+
+        def set_status(self,bri):
+                # Set the Hue status and let the state table know
+                self.bri = bri
                 if int(self.bri) == 0:
                     self.on  = "false"
                 else:
                     self.on  = "true"
-                LOGGER.info('%s on=%s bri=%s' % (self.name, self.on, str(self.bri)));
+                self.parent.state.update(self.index, self.on == "true", self.bri)
 
+        #
+        # The Hue commands, they go through the coalescer which calls send
+        # with the last command of a burst, the status is set right away so
+        # Hue sees the new state.
+        #
         def set_on(self):
-                LOGGER.info('%s node.turn_on()' % (self.name));
+                self.log.debug('hue on')
+                self.cancel_transition()
+                if self.on == "false":
+                    self.set_status(255)
+                return self.coalescer.submit('on')
+
+        def set_off(self):
+                self.log.debug('hue off')
+                self.cancel_transition()
+                self.set_status(0)
+                return self.coalescer.submit('off')
+
+        def set_bri(self,value,transition=None):
+                # transition is the Hue transitiontime in 1/10 seconds
+                self.log.debug('hue bri=%s transitiontime=%s',value,transition)
+                if value > 0 and not self.dimmable and not self.set_scene:
+                    # Not dimmable, so it's just an on
+                    return self.set_on()
+                self.cancel_transition()
+                if transition and self.dimmable:
+                    # Fade or step from the current brightness, Hue sees the target right away.
+                    start = int(self.bri) if self.on == "true" else 0
+                    self.set_status(value)
+                    self.transition = Transition(self.name,start,value,transition / 10.0,self.rule['fade'],self.coalescer.submit)
+                    self.parent.metrics.inc('hue_transitions_total',(('kind',self.transition.kind),))
+                    return self.transition.start()
+                self.set_status(value)
+                return self.coalescer.submit('bri',value)
+
+        def in_transition(self):
+                return self.transition is not None and self.transition.active
+
+        def cancel_transition(self):
+                # A new command replaces the transition, the steps not sent yet are dropped.
+                if self.transition is not None:
+                    self.transition.cancel()
+                    self.transition = None
+
+        def send(self,cmd,value):
+                # Called by the coalescer, the dispatcher sends it to the ISY so the
+                # Hue request doesn't have to wait for the ISY.
+                if not self.parent.dispatcher.submit(self.id,self.send_now,(cmd,value),self.sent):
+                    self.update_status()
+                    return False
+                return True
+
+        def sent(self,ret):
+                # Called by the dispatcher when the ISY command is done
+                self.coalescer.done()
+                if ret is False:
+                    LOGGER.error('%s command failed, resetting status' % (self.name))
+                    self.update_status()
+
+        def send_now(self,cmd,value):
+                if self.node is None:
+                    # A refresh will move it to the new connection
+                    self.log.info('%s not sent, ISY connection is gone',cmd)
+                    return False
+                st = time.time()
+                if cmd == 'on':
+                    ret = self.send_on()
+                elif cmd == 'off':
+                    ret = self.send_off()
+                elif cmd == 'fade_up':
+                    ret = self.node.fade_up()
+                    self.log.info('node.fade_up() = %s',ret)
+                elif cmd == 'fade_down':
+                    ret = self.node.fade_down()
+                    self.log.info('node.fade_down() = %s',ret)
+                else:
+                    ret = self.send_bri(value)
+                self.parent.metrics.observe('isy_command_seconds',time.time() - st,(('device',self.name),('cmd',cmd)))
+                return ret
+
+        def isy_state(self):
+                # The (on,bri) last reported by the ISY, scenes are on when any member is
+                # on so commands to them are never dropped.
+                if self.set_scene or self.node is None or self.node.status == pyisy.constants.ISY_VALUE_UNKNOWN:
+                    return None
+                return (int(self.node.status) > 0, int(self.node.status))
+
+        def send_on(self):
                 if self.scene != False:
                         ret = self.scene.turn_on()
-                        LOGGER.info('%s scene.turn_on() = %s' % (self.name, str(ret)));
+                        self.log.info('scene.turn_on() = %s',ret)
                 else:
                         # TODO: If the node is a KPL button, we can't control it, which shows an error.
                         ret = self.node.turn_on()
-                        LOGGER.info('%s node.turn_on() = %s' % (self.name, str(ret)));
+                        self.log.info('node.turn_on() = %s',ret)
                 return ret
 
-        def set_off(self):
-                LOGGER.info('%s node.turn_off()' % (self.name));
+        def send_off(self):
                 if self.scene != False:
                         ret = self.scene.turn_off()
-                        LOGGER.info('%s scene.turn_off() = %s' % (self.name, str(ret)));
+                        self.log.info('scene.turn_off() = %s',ret)
                 else:
                         # TODO: If the node is a KPL button, we can't control it, which shows an error.
                         ret = self.node.turn_off()
+                        self.log.info('node.turn_off() = %s',ret)
                 return ret
 
-        def set_bri(self,value):
-                LOGGER.info('{} on val={} dimmable={}'.format(self.name, value, self.dimmable));
+        def send_bri(self,value):
+                self.log.debug('on val=%s dimmable=%s',value,self.dimmable)
                 # Only set directly on the node when it's dimmable and value is not 0 or 255
                 # 06/21/2020: changed to allow passing 255 value.
                 # TODO: But should we also check if dimmable?
                 if value > 0:
                         if self.set_scene:
-                            LOGGER.info('{} node.set_on()'.format(self.name));
-                            ret = self.set_on()
-                            # TODO: Calculat brightness from scene members?
-                            self.bri = 255
+                            # The brightness follows the members status events
+                            ret = self.send_on()
                         else:
                             if self.dimmable:
                                 # val=bri does not work?
@@ -359,15 +1153,114 @@ class pyhue_isy_node_handler(hue_upnp_super_handler):
                             else:
                                 # val > 254, so just turn on.  This fixes defines that are not dimmable
                                 # like kpl buttons which can't be controlled directly.
-                                LOGGER.info('{} node.set_on()'.format(self.name));
-                                ret = self.set_on()
-                            LOGGER.info('{} node.turn_on({}) = {}'.format(self.name, value, ret));
+                                ret = self.send_on()
+                            self.log.info('node.turn_on(%s) = %s',value,ret)
                 else:
-                        ret = self.set_off()
-                        self.bri = 0
-                LOGGER.info('{} on={} bri={}'.format(self.name, self.on, self.bri));
+                        ret = self.send_off()
+                        self.set_status(0)
+                self.log.debug('on=%s bri=%s',self.on,self.bri)
                 return ret
 
+#
+# A Hue group for an ISY scene.  A group action is a single scene command, the
+# member lights are updated by the ISY status events that follow.
+#
+class pyhue_isy_scene_group():
+
+        def __init__(self, parent, name, scene, lights, index):
+                self.parent = parent
+                self.name   = name
+                self.scene  = scene
+                self.id     = scene.address
+                # pdevices indexes of the spoken devices in the scene
+                self.lights = lights
+                self.index  = index
+
+        def json(self,lights=None):
+                # lights is the part of the group on one bridge, default is all of them
+                if lights is None:
+                    lights = self.lights
+                (any_on,all_on) = self.parent.state.any_all(lights)
+                return {
+                    'name':   self.name,
+                    'type':   'LightGroup',
+                    'lights': [hue_id(index) for index in lights],
+                    'action': {'on': any_on},
+                    'state':  {'any_on': any_on, 'all_on': all_on},
+                }
+
+        def set_action(self,data):
+                # ISY scenes can't be set to a level, so any brightness is on.
+                on = data['on'] if 'on' in data else int(data.get('bri',0)) > 0
+                LOGGER.info('{} scene {} on={}'.format(self.name,self.id,on))
+                func = self.scene.turn_on if on else self.scene.turn_off
+                return self.parent.dispatcher.submit(self.id,func)
+
+#
+# This is the hue_upnp object used for a device before the ISY is connected
+# when starting with warm_start.  It reports the last known state saved in
+# the config and remembers the last command, which is sent to the live device
+# once it takes over.
+#
+class pyhue_snapshot_handler(hue_upnp_super_handler):
+
+        def __init__(self, parent, item):
+                self.parent   = parent
+                self.name     = item['name']
+                self.id       = item['id']
+                self.index    = item['index']
+                self.type     = item.get('type',"On/off light")
+                self.dimmable = self.type == "Dimmable light"
+                self.scene    = False
+                self.xy       = False
+                self.ct       = False
+                self.on       = item['on']
+                self.bri      = item['bri']
+                # The last command received, only the last one matters.
+                self.pending  = None
+                super(pyhue_snapshot_handler,self).__init__(self.name)
+
+        def get_all(self):
+                self.parent.hue_response()
+                bri = self.bri
+                super(pyhue_snapshot_handler,self).get_all()
+                self.set_status(bri)
+
+        def set_status(self,bri):
+                self.bri = bri
+                self.on  = "false" if int(self.bri) == 0 else "true"
+                self.parent.state.update(self.index, self.on == "true", self.bri)
+
+        def set_on(self):
+                if self.on == "false":
+                    self.set_status(255)
+                return self.queue('set_on')
+
+        def set_off(self):
+                self.set_status(0)
+                return self.queue('set_off')
+
+        def set_bri(self,value,transition=None):
+                self.set_status(value)
+                return self.queue('set_bri',value,transition)
+
+        def queue(self,cmd,*args):
+                LOGGER.warning('{} ISY not connected yet, queued {}{}'.format(self.name,cmd,args))
+                self.pending = (cmd,args)
+                return True
+
+        def takeover(self):
+                # Called when the live devices have replaced this one, send the last command.
+                if self.pending is None:
+                    return
+                (cmd,args) = self.pending
+                device = self.parent.pdevices[self.index] if self.index < len(self.parent.pdevices) else False
+                if device is False or device.id != self.id:
+                    LOGGER.error('{} Rejected queued {}{}, device {} no longer exists'.format(self.name,cmd,args,self.id))
+                    return
+                LOGGER.info('{} Sending queued {}{}'.format(self.name,cmd,args))
+                getattr(device,cmd)(*args)
+
 # TODO: Somday support setting ISY variables?
 #class pyhue_isy_var_handler(hue_upnp_super_handler):
 #        def __init__(self, parent, name, var):
@@ -0,0 +1,68 @@
+#
+# The ISYSession object.
+#
+# The requests session used for all the ISY REST calls, it replaces the pyisy
+# connection session so device commands and notes requests share a few
+# keep-alive connections.  The number of connections is capped, requests wait
+# for a free one instead of opening more.  It keeps the latency of the last
+# requests, and the connection pool counts how often a connection was reused.
+#
+
+import time
+import logging
+import requests
+from collections import deque
+from requests.adapters import HTTPAdapter
+
+LOGGER = logging.getLogger(__name__)
+
+class ISYSession(requests.Session):
+
+    def __init__(self,max_connections=4):
+        super(ISYSession,self).__init__()
+        self.max_connections = max(1,max_connections)
+        self.adapter = HTTPAdapter(pool_connections=1,pool_maxsize=self.max_connections,pool_block=True)
+        self.mount('http://',self.adapter)
+        self.mount('https://',self.adapter)
+        # The last latencies in seconds
+        self.latencies = deque(maxlen=500)
+        self.errors    = 0
+
+    def install(self,isy):
+        # Use this session for all requests from the pyisy connection.
+        # HTTPS has it's own TLS adapter so it's left alone.
+        if isy.conn.use_https:
+            LOGGER.warning('ISY uses HTTPS, not using the shared connection pool')
+            return False
+        old = isy.conn.req_session
+        isy.conn.req_session = self
+        old.close()
+        LOGGER.info('ISY requests use {} pooled connections'.format(self.max_connections))
+        return True
+
+    def request(self,method,url,*args,**kwargs):
+        st = time.time()
+        try:
+            return super(ISYSession,self).request(method,url,*args,**kwargs)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.latencies.append(time.time() - st)
+
+    def get_stats(self):
+        stats = {'requests': 0, 'connections': 0, 'errors': self.errors}
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats['requests']    += pool.num_requests
+            stats['connections'] += pool.num_connections
+        stats['reused'] = max(0,stats['requests'] - stats['connections'])
+        latencies = sorted(self.latencies)
+        if len(latencies) > 0:
+            stats['latency_p50_ms'] = round(latencies[len(latencies) // 2] * 1000, 1)
+            stats['latency_p99_ms'] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 1)
+            stats['latency_max_ms'] = round(latencies[-1] * 1000, 1)
+        return stats
@@ -0,0 +1,153 @@
+#
+# The ISYSupervisor object.
+#
+# Keeps the ISY connection up without restarting the Hue server.  Connecting
+# is retried with exponential backoff and jitter, and when the event stream
+# is lost and pyisy can't get it back a new pyisy connection is made and the
+# parent rebinds the current handlers to it.  When pyisy does get it back the
+# events sent while it was down are missed, so the parent reconciles the
+# device status.
+#
+
+import time
+import random
+import logging
+from threading import Thread,Event
+import pyisy
+
+LOGGER = logging.getLogger(__name__)
+
+class ISYSupervisor():
+
+    # Seconds between checks that the event stream is still running
+    check_interval = 30
+
+    def __init__(self,parent,min_delay=1.0,max_delay=60.0):
+        self.parent    = parent
+        self.min_delay = max(0.1,min_delay)
+        self.max_delay = max(self.min_delay,max_delay)
+        self.running   = True
+        # Set to stop waiting before the next try, when stopping or the params changed
+        self.wake      = Event()
+        self.lost      = Event()
+        # Set by reconnect_now so run knows the connection wasn't lost
+        self.requested = False
+        # Set while pyisy is reconnecting the event stream, and when it's back
+        self.reconnecting = False
+        self.resumed   = False
+        self.thread    = None
+        self.listener  = None
+        self.stats     = {'attempts': 0, 'failures': 0, 'reconnects': 0, 'resumed': 0, 'last_recovery_s': None}
+
+    def delay(self,attempt):
+        # Exponential backoff, with half of it random so restarts don't all retry together.
+        delay = min(self.max_delay, self.min_delay * (2 ** min(attempt,16)))
+        return delay / 2 + random.uniform(0,delay / 2)
+
+    def open(self):
+        """
+        Connect to the ISY, trying again until connected or stopped.
+        Returns the pyisy.ISY or None when stopped.
+        """
+        attempt = 0
+        self.wake.clear()
+        while self.running:
+            self.stats['attempts'] += 1
+            isy = self.parent.open_isy()
+            if isy is not None:
+                return isy
+            self.stats['failures'] += 1
+            delay = self.delay(attempt)
+            attempt += 1
+            LOGGER.error('ISY not connected after {} tries, will try again in {:.1f} seconds'.format(attempt,delay))
+            self.wake.wait(delay)
+            self.wake.clear()
+        return None
+
+    def watch(self,isy):
+        # Listen for pyisy giving up on the event stream of this connection.
+        if self.listener is not None:
+            self.listener.unsubscribe()
+        self.lost.clear()
+        self.reconnecting = False
+        self.resumed = False
+        self.listener = isy.connection_events.subscribe(self.connection_event)
+
+    def connection_event(self,e):
+        LOGGER.info('ISY connection event {}'.format(e))
+        if e == pyisy.constants.ES_RECONNECT_FAILED:
+            self.reconnecting = False
+            self.lost.set()
+        elif e == pyisy.constants.ES_LOST_STREAM_CONNECTION:
+            self.reconnecting = True
+        elif e == pyisy.constants.ES_CONNECTED and self.reconnecting:
+            # Reconcile in run, not in the pyisy event thread
+            self.reconnecting = False
+            self.resumed = True
+            self.lost.set()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = Thread(name='ISYSupervisor',target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def reconnect_now(self):
+        # Connect again without waiting, the parent has new params for the ISY.
+        self.wake.set()
+        if self.thread is not None:
+            self.requested = True
+            self.lost.set()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        self.lost.set()
+        if self.listener is not None:
+            self.listener.unsubscribe()
+            self.listener = None
+
+    def run(self):
+        down = 0
+        while self.running:
+            lost = self.lost.wait(self.check_interval)
+            if not self.running:
+                break
+            isy = self.parent.isy
+            if self.resumed and not self.requested:
+                self.resumed = False
+                self.lost.clear()
+                LOGGER.warning('ISY event stream reconnected, reconciling the device status')
+                self.stats['resumed'] += 1
+                self.parent.reconcile()
+                continue
+            if self.requested:
+                self.requested = False
+                LOGGER.warning('Connecting to the ISY again with the new params')
+            elif lost:
+                LOGGER.error('ISY event stream lost')
+            elif isy is not None and isy.auto_update:
+                down = 0
+                continue
+            else:
+                # pyisy may be reconnecting the stream, wait for the next check before taking over.
+                down += 1
+                if down < 2:
+                    continue
+                LOGGER.error('ISY event stream not running')
+            down = 0
+            self.reconnect()
+
+    def reconnect(self):
+        st = time.time()
+        isy = self.open()
+        if isy is None:
+            return False
+        if not self.parent.use_isy(isy):
+            LOGGER.error('Refresh after reconnect failed, devices may not be updated until the next refresh')
+            return False
+        self.stats['reconnects'] += 1
+        self.stats['last_recovery_s'] = round(time.time() - st,2)
+        LOGGER.warning('ISY reconnected in {} seconds'.format(self.stats['last_recovery_s']))
+        return True
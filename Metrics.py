@@ -0,0 +1,165 @@
+#
+# The Metrics object.
+#
+# Counters and latency summaries from the busy parts of the emulator, served
+# in the Prometheus text format on the port after the Hue port.  Recording a
+# value is a dict update under a lock, the quantiles are only calculated when
+# the metrics are requested, from the last samples of each summary.
+#
+
+import os
+import logging
+import resource
+from collections import deque
+from threading import Lock,Thread
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+
+LOGGER = logging.getLogger(__name__)
+
+PREFIX = 'hue_emu_'
+
+def process_rss():
+    # Resident memory of this process in bytes, the peak where /proc is not available
+    try:
+        with open('/proc/self/statm') as ifile:
+            return int(ifile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class Metrics():
+
+    # Samples kept per summary for the quantiles
+    max_samples = 500
+    quantiles   = [0.5, 0.9, 0.99]
+
+    def __init__(self):
+        self.lock      = Lock()
+        # name: (type, help)
+        self.info      = dict()
+        # name: {labels: value}, labels is a tuple of (label,value)
+        self.counters  = dict()
+        # name: {labels: [count, sum, deque of samples]}
+        self.summaries = dict()
+        # name: function returning {labels: value}, called when rendering
+        self.gauges    = dict()
+        self.httpd     = None
+        self.thread    = None
+
+    def describe(self,name,mtype,help):
+        self.info[name] = (mtype,help)
+
+    def inc(self,name,labels=(),value=1):
+        with self.lock:
+            values = self.counters.setdefault(name,dict())
+            values[labels] = values.get(labels,0) + value
+
+    def observe(self,name,seconds,labels=()):
+        with self.lock:
+            values = self.summaries.setdefault(name,dict())
+            summary = values.get(labels)
+            if summary is None:
+                summary = values[labels] = [0, 0.0, deque(maxlen=self.max_samples)]
+            summary[0] += 1
+            summary[1] += seconds
+            summary[2].append(seconds)
+
+    def gauge(self,name,help,func,mtype='gauge'):
+        # mtype can be counter for totals kept by other objects
+        self.describe(name,mtype,help)
+        self.gauges[name] = func
+
+    def get_count(self,name):
+        # Total of a counter, or the number of observations of a summary, for all labels.
+        with self.lock:
+            if name in self.counters:
+                return sum(self.counters[name].values())
+            return sum(summary[0] for summary in self.summaries.get(name,dict()).values())
+
+    def get_quantile(self,name,quantile):
+        # The quantile in seconds of the recent samples of a summary for all labels, None if no samples.
+        with self.lock:
+            samples = sorted(sample for summary in self.summaries.get(name,dict()).values() for sample in summary[2])
+        if len(samples) == 0:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * quantile))]
+
+    @staticmethod
+    def format_labels(labels,extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if len(labels) == 0:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key,str(value).replace('\\','\\\\').replace('"','\\"')) for key, value in labels) + '}'
+
+    def render(self):
+        with self.lock:
+            counters  = {name: dict(values) for name, values in self.counters.items()}
+            summaries = {name: {labels: (s[0], s[1], sorted(s[2])) for labels, s in values.items()} for name, values in self.summaries.items()}
+        lines = []
+        for name, values in counters.items():
+            self.header(lines,name,'counter')
+            for labels, value in values.items():
+                lines.append('{}{}{} {}'.format(PREFIX,name,self.format_labels(labels),value))
+        for name, values in summaries.items():
+            self.header(lines,name,'summary')
+            for labels, (count, total, samples) in values.items():
+                for quantile in self.quantiles:
+                    if len(samples) > 0:
+                        value = samples[min(len(samples) - 1, int(len(samples) * quantile))]
+                        lines.append('{}{}{} {:.6f}'.format(PREFIX,name,self.format_labels(labels,(('quantile',quantile),)),value))
+                lines.append('{}{}_sum{} {:.6f}'.format(PREFIX,name,self.format_labels(labels),total))
+                lines.append('{}{}_count{} {}'.format(PREFIX,name,self.format_labels(labels),count))
+        for name, func in self.gauges.items():
+            try:
+                values = func()
+            except Exception as ex:
+                LOGGER.error('Gauge {} failed: {}'.format(name,ex))
+                continue
+            self.header(lines,name,self.info[name][0])
+            for labels, value in values.items():
+                lines.append('{}{}{} {}'.format(PREFIX,name,self.format_labels(labels),value))
+        return '\n'.join(lines) + '\n'
+
+    def header(self,lines,name,mtype):
+        (mtype,help) = self.info.get(name,(mtype,name))
+        lines.append('# HELP {}{} {}'.format(PREFIX,name,help))
+        lines.append('# TYPE {}{} {}'.format(PREFIX,name,mtype))
+
+    #
+    # The HTTP server for /metrics
+    #
+    def start(self,host,port):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                data = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type','text/plain; version=0.0.4')
+                self.send_header('Content-Length',str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self,format,*args):
+                pass
+
+        try:
+            self.httpd = ThreadingHTTPServer((host,port),MetricsHandler)
+        except OSError as ex:
+            LOGGER.error('Unable to serve metrics on {}:{}: {}'.format(host,port,ex))
+            return False
+        self.httpd.daemon_threads = True
+        self.thread = Thread(name='Metrics',target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        LOGGER.info('Serving metrics on http://{}:{}/metrics'.format(host,port))
+        return True
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
@@ -0,0 +1,167 @@
+#
+# The NotesCache object.
+#
+# Remembers the Spoken property of each ISY node so a refresh, or a restart,
+# doesn't have to request the notes of every node from the ISY again.
+# Each entry is saved with a signature of the node, when that changes the
+# notes are requested again.  The entries that were used from the cache are
+# checked again in the background, for as long as notes_recheck_time allows.
+#
+
+import time
+import logging
+from threading import Thread,Lock
+from xml.dom import minidom
+from pyisy.constants import TAG_SPOKEN,URL_NODES,URL_NOTES,XML_ERRORS
+from pyisy.helpers import value_from_xml
+
+LOGGER = logging.getLogger(__name__)
+
+class NotesCache():
+
+    def __init__(self,parent,notes=None):
+        self.parent  = parent
+        self.lock    = Lock()
+        # address: { 'spoken': spoken, 'sig': signature, 'checked': time }
+        self.notes   = dict() if notes is None else dict(notes)
+        self.thread  = None
+        self.hits    = 0
+        self.fetched = 0
+
+    @staticmethod
+    def signature(node):
+        # Anything that usually changes when a device is replaced or reconfigured.
+        parent = getattr(node,'parent_node',None)
+        return '|'.join([
+            str(node.name),
+            type(node).__name__,
+            str(getattr(node,'type',None)),
+            str(getattr(node,'node_def_id',None)),
+            'None' if parent is None else str(parent.address),
+        ])
+
+    @staticmethod
+    def fetch(node):
+        """
+        Returns (True,spoken), or (False,None) when the notes could not be
+        read.  node.parse_notes can't be used since it returns no Spoken for
+        a failed request too, which would remove the device.
+        """
+        try:
+            conn = node.isy.conn
+            # A node without notes is a 404, that's an empty string, a failure is None
+            notes = conn.request(conn.compile_url([URL_NODES,node.address,URL_NOTES]),ok404=True)
+        except Exception as ex:
+            LOGGER.error('Unable to get notes for {}: {}'.format(node,ex), exc_info=True)
+            return (False,None)
+        if notes is None:
+            LOGGER.error('Unable to get notes for {}'.format(node))
+            return (False,None)
+        if notes == '':
+            return (True,None)
+        try:
+            return (True,value_from_xml(minidom.parseString(notes),TAG_SPOKEN))
+        except XML_ERRORS as ex:
+            LOGGER.error('Unable to parse notes for {}: {}'.format(node,ex))
+            return (False,None)
+
+    def get(self,node):
+        """
+        Returns (True,spoken) if node is in the cache and looks the same
+        as when it was saved, otherwise (False,None)
+        """
+        with self.lock:
+            item = self.notes.get(node.address)
+        if item is None or item['sig'] != self.signature(node):
+            return (False,None)
+        return (True,item['spoken'])
+
+    def set(self,node,spoken):
+        with self.lock:
+            self.notes[node.address] = {'spoken': spoken, 'sig': self.signature(node), 'checked': time.time()}
+
+    def prune(self,addresses):
+        # Forget about nodes no longer on the ISY
+        addresses = set(addresses)
+        with self.lock:
+            for address in [a for a in self.notes if a not in addresses]:
+                LOGGER.debug('Removing {}'.format(address))
+                del self.notes[address]
+
+    def copy(self):
+        with self.lock:
+            return dict(self.notes)
+
+    def get_spokens(self,nodes,fetch_all):
+        """
+        Returns the Spoken of each node in the same order, only requesting
+        the notes for nodes not in the cache.  fetch_all(nodes) is used to
+        request the ones that are missing, it returns the fetch result of
+        each one.  When a request fails the last Spoken known for the node
+        is used and it's requested again next time.
+        """
+        spokens = [None] * len(nodes)
+        missing = []
+        cached  = []
+        for i, node in enumerate(nodes):
+            (hit,spoken) = self.get(node)
+            if hit:
+                spokens[i] = spoken
+                cached.append(node)
+            else:
+                missing.append(i)
+        fetched = fetch_all([nodes[i] for i in missing])
+        failed  = 0
+        for i, (ok,spoken) in zip(missing, fetched):
+            if ok:
+                spokens[i] = spoken
+                self.set(nodes[i],spoken)
+            else:
+                failed += 1
+                with self.lock:
+                    item = self.notes.get(nodes[i].address)
+                spokens[i] = None if item is None else item['spoken']
+        if failed > 0:
+            LOGGER.error('Unable to get notes for {} nodes, using the last known Spoken'.format(failed))
+        self.hits    = len(cached)
+        self.fetched = len(missing)
+        LOGGER.info('Notes cache saved {} of {} notes requests, fetched {}'.format(self.hits,len(nodes),self.fetched))
+        self.prune([node.address for node in nodes])
+        self.start_recheck(cached)
+        return spokens
+
+    def start_recheck(self,nodes):
+        timeout = self.parent.options['notes_recheck_time']
+        if timeout <= 0 or len(nodes) == 0:
+            return
+        if self.thread is not None and self.thread.is_alive():
+            LOGGER.info('Recheck already running')
+            return
+        self.thread = Thread(name='NotesRecheck',target=self.recheck,args=(nodes,timeout))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def recheck(self,nodes,timeout):
+        # Oldest checked first, so the ones not reached this time are first next time.
+        with self.lock:
+            nodes = sorted(nodes, key=lambda node: self.notes[node.address]['checked'] if node.address in self.notes else 0)
+        st = time.time()
+        changed = 0
+        checked = 0
+        for node in nodes:
+            if time.time() - st > timeout:
+                LOGGER.warning('Stopping after {} seconds, rechecked {} of {}'.format(timeout,checked,len(nodes)))
+                break
+            (hit,spoken) = self.get(node)
+            (ok,nspoken) = self.fetch(node)
+            if not ok:
+                # Keep the cached one, a failed request is not a change
+                continue
+            checked += 1
+            if not hit or nspoken != spoken:
+                LOGGER.warning('Spoken changed for {} from "{}" to "{}"'.format(node.address,spoken,nspoken))
+                changed += 1
+            self.set(node,nspoken)
+        LOGGER.info('Rechecked {} notes in {:.2f} seconds, {} changed'.format(checked,time.time()-st,changed))
+        if changed > 0:
+            self.parent.refresh()
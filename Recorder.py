@@ -0,0 +1,77 @@
+#
+# The Recorder object.
+#
+# Records the ISY status events and Hue requests the emulator gets, so a
+# problem seen on a real install, like an event storm after the ISY reboots
+# or a burst of polls, can be replayed offline with bench/replay.py.  The
+# recording is gzip compressed JSON lines, the first line has the nodes and
+# scenes of the spoken devices, then one line for each event or request with
+# the seconds since the start, and the last line has the Hue state of each
+# device when the recording ended.
+#
+
+import gzip
+import json
+import time
+import logging
+from threading import Timer,Lock
+
+LOGGER = logging.getLogger(__name__)
+
+class Recorder():
+
+    version = 1
+
+    def __init__(self,path,layout,seconds,states):
+        """
+        layout is the nodes, scenes, devices and groups from ISYHueEmu.recording_layout,
+        states() returns {address: [on,bri]} for the last line.  Recording
+        stops after seconds or when close is called.
+        """
+        self.path   = path
+        self.states = states
+        self.start  = time.time()
+        self.lock   = Lock()
+        self.stats  = {'events': 0, 'requests': 0}
+        self.fh     = gzip.open(path,'wt',encoding='utf-8')
+        self.write(dict(layout,recording=self.version,time=self.start))
+        self.timer  = Timer(seconds,self.close)
+        self.timer.daemon = True
+        self.timer.start()
+        LOGGER.warning('Recording to {} for {} seconds'.format(path,seconds))
+
+    def write(self,item):
+        self.fh.write(json.dumps(item,separators=(',',':')) + '\n')
+
+    def add(self,stat,item):
+        with self.lock:
+            if self.fh is None:
+                return False
+            self.stats[stat] += 1
+            self.write([round(time.time() - self.start,4)] + item)
+        return True
+
+    def event(self,address,status):
+        # An ISY status event delivered to a device handler
+        return self.add('events',['e',address,status])
+
+    def request(self,shard,method,path,body):
+        # A Hue request to the bridge shard
+        return self.add('requests',['h',shard,method,path,body])
+
+    @property
+    def recording(self):
+        return self.fh is not None
+
+    def close(self):
+        self.timer.cancel()
+        with self.lock:
+            if self.fh is None:
+                return
+            self.write({'end': round(time.time() - self.start,4), 'states': self.states(), 'stats': self.stats})
+            self.fh.close()
+            self.fh = None
+        LOGGER.warning('Recorded {} to {}'.format(self.stats,self.path))
+
+    def get_stats(self):
+        return dict(self.stats,path=self.path,recording=self.recording)
@@ -0,0 +1,158 @@
+#
+# The SSDPResponder object.
+#
+# Answers SSDP M-SEARCH requests so clients can find the native Hue bridges,
+# only while the parent is listening.  The replies for each search target
+# are built once, the same search from the same address is only answered
+# once a second, and each address has a rate limit, so a discovery storm
+# from a busy network costs little more than reading the packets.
+#
+
+import time
+import socket
+import struct
+import logging
+from threading import Thread
+
+LOGGER = logging.getLogger(__name__)
+
+SSDP_ADDR = '239.255.255.250'
+SSDP_PORT = 1900
+
+class SSDPResponder():
+
+    # Searches from one address answered at once before the rate applies
+    burst         = 5
+    # Seconds the same search from the same address is only answered once
+    dedupe_window = 1.0
+    # Addresses remembered for the rate limit, the oldest are forgotten after this
+    max_sources   = 1024
+
+    def __init__(self,apis,rate=2.0,port=SSDP_PORT,multicast=True):
+        """
+        apis are the HueApi of each bridge, they all have the same host and
+        parent.  rate is the searches per second answered for each address.
+        port and multicast are only changed for testing on loopback.
+        """
+        self.apis      = apis
+        self.api       = apis[0]
+        self.rate      = rate
+        self.port      = port
+        self.multicast = multicast
+        self.sock      = None
+        self.running   = False
+        self.thread    = None
+        # st: [reply], for the search targets we answer
+        self.replies   = dict()
+        for api in apis:
+            for st in self.search_targets(api):
+                self.replies.setdefault(st,[]).append(self.reply(api,st).encode('utf-8'))
+        self.replies['ssdp:all'] = [self.reply(api,st).encode('utf-8') for api in apis for st in self.search_targets(api)]
+        # address: [tokens, last time, {st: last answered}]
+        self.sources   = dict()
+        self.stats     = {'received': 0, 'searches': 0, 'answered': 0, 'replies': 0, 'not_listening': 0, 'other': 0, 'duplicate': 0, 'rate_limited': 0}
+
+    def start(self,host=''):
+        self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM,socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        # A bigger buffer drops fewer packets during a storm, the system may limit it
+        self.sock.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,1 << 20)
+        self.sock.bind((host,self.port))
+        if self.multicast:
+            mreq = struct.pack('4s4s',socket.inet_aton(SSDP_ADDR),socket.inet_aton(self.api.host))
+            self.sock.setsockopt(socket.IPPROTO_IP,socket.IP_ADD_MEMBERSHIP,mreq)
+        # The port it's bound to, when testing with port 0
+        self.port = self.sock.getsockname()[1]
+        self.sock.settimeout(1)
+        self.running = True
+        self.thread = Thread(name='SSDPResponder',target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            try:
+                (data,addr) = self.sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError as ex:
+                LOGGER.error('SSDP receive failed: {}'.format(ex))
+                break
+            for reply in self.handle(data,addr):
+                try:
+                    self.sock.sendto(reply,addr)
+                except OSError as ex:
+                    LOGGER.debug('SSDP reply to {} failed: {}'.format(addr,ex))
+        self.sock.close()
+
+    def handle(self,data,addr,now=None):
+        # Returns the replies to send for a packet, and counts why when there are none.
+        self.stats['received'] += 1
+        if not data.startswith(b'M-SEARCH'):
+            self.stats['other'] += 1
+            return []
+        self.stats['searches'] += 1
+        if not self.api.parent.listening:
+            self.stats['not_listening'] += 1
+            return []
+        st = None
+        for line in data.decode('utf-8','ignore').split('\r\n'):
+            if line.upper().startswith('ST:'):
+                st = line[3:].strip()
+        replies = self.replies.get(st)
+        if replies is None:
+            # Looking for something else
+            self.stats['other'] += 1
+            return []
+        if now is None:
+            now = time.time()
+        source = self.sources.get(addr[0])
+        if source is None:
+            if len(self.sources) >= self.max_sources:
+                self.forget(now)
+            source = self.sources[addr[0]] = [self.burst,now,dict()]
+        if now - source[2].get(st,0) < self.dedupe_window:
+            self.stats['duplicate'] += 1
+            return []
+        source[0] = min(self.burst,source[0] + (now - source[1]) * self.rate)
+        source[1] = now
+        if source[0] < 1:
+            self.stats['rate_limited'] += 1
+            return []
+        source[0] -= 1
+        source[2][st] = now
+        self.stats['answered'] += 1
+        self.stats['replies'] += len(replies)
+        return replies
+
+    def forget(self,now):
+        # Drop the addresses not heard from recently, or the oldest half when they all were.
+        old = [address for address, source in self.sources.items() if now - source[1] > 60]
+        if len(old) == 0:
+            old = sorted(self.sources,key=lambda address: self.sources[address][1])[:len(self.sources) // 2]
+        for address in old:
+            del self.sources[address]
+
+    @staticmethod
+    def search_targets(api):
+        return ['upnp:rootdevice', 'uuid:' + api.bridge['uuid'], 'urn:schemas-upnp-org:device:basic:1']
+
+    @staticmethod
+    def reply(api,st):
+        bridge = api.bridge
+        usn = 'uuid:' + bridge['uuid']
+        if st != usn:
+            usn += '::' + st
+        return ('HTTP/1.1 200 OK\r\n'
+            'HOST: {}:{}\r\n'
+            'EXT:\r\n'
+            'CACHE-CONTROL: max-age=100\r\n'
+            'LOCATION: http://{}:{}/description.xml\r\n'
+            'SERVER: Linux/3.14.0 UPnP/1.0 IpBridge/1.41.0\r\n'
+            'hue-bridgeid: {}\r\n'
+            'ST: {}\r\n'
+            'USN: {}\r\n'
+            '\r\n').format(SSDP_ADDR,SSDP_PORT,api.host,api.port,bridge['bridgeid'],st,usn)
@@ -0,0 +1,79 @@
+#
+# The SceneState object.
+#
+# pyisy reports a scene as 255 when any member is on, so a Hue scene would
+# always be full brightness.  This listens to the status of the responders
+# in the scene and keeps a running total of their levels, each event only
+# adjusts the total by the change of that member, so the brightness of the
+# scene is the mean level without reading all the members again.
+#
+
+import logging
+from functools import partial
+from threading import Lock
+import pyisy
+
+LOGGER = logging.getLogger(__name__)
+
+class SceneState():
+
+    def __init__(self,scene,nodes,changed):
+        """
+        scene is the pyisy Group, nodes the pyisy Nodes to find the members
+        and changed(address,level) is called with the member that changed
+        when the scene brightness changed.
+        """
+        self.scene     = scene
+        self.changed   = changed
+        self.levels    = dict()
+        self.total     = 0
+        self.listeners = []
+        # Member events can come from more than one thread
+        self.lock      = Lock()
+        # The responders, controllers of the scene are usually buttons which don't follow it.
+        controllers = set(scene.controllers)
+        members = [address for address in scene.members if address not in controllers]
+        if len(members) == 0:
+            members = list(scene.members)
+        for address in members:
+            try:
+                node = nodes[address]
+            except Exception:
+                node = None
+            if node is None:
+                LOGGER.warning('{} member {} not found'.format(scene.name,address))
+                continue
+            level = self.level(node.status)
+            self.levels[address] = level
+            self.total += level
+            self.listeners.append(node.status_events.subscribe(partial(self.update,address,node)))
+        LOGGER.debug('{} responders={} bri={}'.format(scene.name,len(self.levels),self.bri()))
+
+    @staticmethod
+    def level(status):
+        if status is None or status == pyisy.constants.ISY_VALUE_UNKNOWN:
+            return 0
+        return int(status)
+
+    def update(self,address,node,e):
+        level = self.level(node.status)
+        with self.lock:
+            old = self.levels[address]
+            if level == old:
+                return
+            self.levels[address] = level
+            self.total += level - old
+        # Outside the lock, it reads bri
+        self.changed(address,level)
+
+    def bri(self):
+        with self.lock:
+            if len(self.levels) == 0:
+                return 0
+            return int(round(self.total / len(self.levels)))
+
+    def release(self):
+        with self.lock:
+            (listeners,self.listeners) = (self.listeners,[])
+        for listener in listeners:
+            listener.unsubscribe()
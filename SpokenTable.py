@@ -0,0 +1,98 @@
+#
+# The SpokenTable object.
+#
+# The Spoken Device Table shown on the Polyglot Configuration page.  The row
+# of each device is kept rendered and only rendered again when the HueState
+# entry of that device changed, and nothing is rendered when nothing changed
+# since the last time.  Only the first max_rows devices are shown, the rest
+# are summarized in one line.
+#
+
+import logging
+import pyisy
+
+LOGGER = logging.getLogger(__name__)
+
+HEADER = [
+    '<h1>Spoken Device Table</h1>',
+    'This table is updated during short poll when devices change, so it may be out of date for up to docs_interval seconds<br>',
+    '<table border=1>',
+    '<tr><th colspan=3><center>Hue<th rowspan=2><center>NSId<th colspan=2><center>Property Node/Scene<th colspan=3><center>Scene<th rowspan=2><center>Spoken<th rowspan=2><center>On<th rowspan=2><center>Bri</tr>',
+    '<tr><th><center>Id<th><center>Type<th><center>Rule<th><center>Id<th><center>NodeDefId<th><center>Name<th><center>Scene<th><center>Name<th></tr>']
+
+class SpokenTable():
+
+    def __init__(self):
+        # index: (device, version, row)
+        self.rows    = dict()
+        # What the html was rendered from: (emulator, state version, number of devices, max_rows)
+        self.key     = None
+        self.html    = None
+        # Tables and rows rendered
+        self.renders = 0
+        self.built   = 0
+
+    def get_html(self,emu,max_rows=250):
+        """
+        Returns the table for the devices of the emulator, or for none if emu
+        is False.  Returns the same string object until something changes.
+        """
+        if emu is False:
+            devices = []
+            key = (None,None,0,max_rows)
+        else:
+            devices = emu.pdevices
+            key = (id(emu),emu.state.version,len(devices),max_rows)
+        if key == self.key:
+            return self.html
+        self.renders += 1
+        for index in [index for index in self.rows if index >= len(devices)]:
+            del self.rows[index]
+        html = list(HEADER)
+        for i, device in enumerate(devices[:max_rows]):
+            version = False if device is False else emu.state.get_version(i)
+            cached = self.rows.get(i)
+            if cached is None or cached[0] is not device or cached[1] != version:
+                cached = self.rows[i] = (device,version,self.row(i,device))
+                self.built += 1
+            html.append(cached[2])
+        if len(devices) > max_rows:
+            html.append(self.summary(devices[max_rows:]))
+        html.append('</table>')
+        self.key  = key
+        self.html = "\n".join(html)
+        return self.html
+
+    @staticmethod
+    def summary(devices):
+        # One line for the devices that are not shown
+        scenes = len([1 for device in devices if device is not False and getattr(device,'is_scene',False)])
+        on     = len([1 for device in devices if device is not False and device.on == "true"])
+        empty  = len([1 for device in devices if device is False])
+        return '<tr><td colspan=12>&nbsp;{} more devices not shown, {} scenes, {} on, {} empty&nbsp;</tr>'.format(len(devices),scenes,on,empty)
+
+    @staticmethod
+    def row(i,device):
+        # Only used for debug
+        if device is False:
+            return '<tr><td>{}<td colspan=10>empty</tr>'.format(i)
+        if not hasattr(device,'node'):
+            # Saved device from a warm start
+            return ('<tr><td>{}<td>&nbsp;{}&nbsp;<td>&nbsp;saved&nbsp;<td>&nbsp;{}&nbsp;<td colspan=5>&nbsp;Waiting for ISY&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;</tr>'.
+                format(i,device.type,device.id,device.name,device.on,device.bri))
+        if device.node is None or device.scene is None:
+            # The ISY connection it was from is gone
+            return ('<tr><td>{}<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td colspan=5>&nbsp;Unavailable&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;</tr>'.
+                format(i,device.type,device.rule['rule'],device.id,device.name,device.on,device.bri))
+        if device.node.protocol == pyisy.constants.PROTO_GROUP:
+            dtype = 'Scene'
+        else:
+            dtype = device.node.node_def_id
+        if device.scene is False:
+            return ('<tr><td>{}<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td colspan=2>&nbsp;None&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;</tr>'.
+                format(i,device.type,device.rule['rule'],device.id,device.node,dtype,device.node.name,device.name,device.on,device.bri))
+        return ('<tr><td>&nbsp;{}&nbsp;<td>{}<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;</tr>'.
+            format(i,device.type,device.rule['rule'],device.id,device.node,dtype,device.node.name,device.scene,device.scene.name,device.name,device.on,device.bri))
+
+    def stats(self):
+        return {'rows': len(self.rows), 'renders': self.renders, 'built': self.built}
@@ -0,0 +1,75 @@
+#
+# The Transition object.
+#
+# A Hue transitiontime for one device.  Insteon dimmers can fade on their
+# own, so the fade is started and the target brightness is sent when the
+# fade should have reached it, two ISY commands for the whole transition.
+# Other dimmable devices get a few coarse steps spread over the time.  The
+# commands go through the device's CommandCoalescer like any other command.
+#
+
+import logging
+from threading import Timer,Lock
+
+LOGGER = logging.getLogger(__name__)
+
+class Transition():
+
+    # Seconds an Insteon fade takes from off to full on
+    fade_seconds = 4.5
+    # Most steps sent for devices that can't fade, and the least seconds between them
+    max_steps    = 4
+    min_step     = 1.0
+
+    def __init__(self,name,start,target,seconds,fade,submit):
+        """
+        Change from the start to the target brightness in seconds.  fade is
+        True when the device can fade, submit(cmd,value) sends a command.
+        """
+        self.name    = name
+        self.target  = target
+        self.submit  = submit
+        self.kind    = 'fade' if fade else 'steps'
+        self.steps   = self.plan(start,target,seconds,fade)
+        self.lock    = Lock()
+        self.timer   = None
+        self.active  = False
+
+    @classmethod
+    def plan(cls,start,target,seconds,fade):
+        # [(seconds from the start,cmd,value)]
+        delta = target - start
+        if delta == 0 or seconds <= 0:
+            return [(0,'bri',target)]
+        if fade:
+            # The fade can't be slowed down, so when it takes less than seconds it ends early.
+            return [(0,'fade_up' if delta > 0 else 'fade_down',None), (min(seconds,cls.fade_seconds * abs(delta) / 255),'bri',target)]
+        count = max(1,min(cls.max_steps,int(seconds / cls.min_step)))
+        # Each step is sent when the one before should be reached, the device ramps to it.
+        return [(seconds * i / count,'bri',int(round(start + delta * (i + 1) / count))) for i in range(count)]
+
+    def start(self):
+        LOGGER.debug('{} {} to {} {}'.format(self.name,self.kind,self.target,self.steps))
+        self.active = True
+        return self.run(0)
+
+    def run(self,i):
+        with self.lock:
+            if not self.active:
+                return False
+            (at,cmd,value) = self.steps[i]
+            if i + 1 < len(self.steps):
+                self.timer = Timer(self.steps[i + 1][0] - at,self.run,(i + 1,))
+                self.timer.daemon = True
+                self.timer.start()
+            else:
+                self.timer  = None
+                self.active = False
+        return self.submit(cmd,value)
+
+    def cancel(self):
+        with self.lock:
+            self.active = False
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
@@ -0,0 +1,292 @@
+#
+# The FakeISY object.
+#
+# A local ISY for the benchmarks.  It serves the REST calls pyisy and the
+# emulator use, nodes, status, notes and commands, and the event stream on
+# the same port.  Nodes, scenes and Spoken notes are made up from a few
+# numbers so any size of install can be tested without a real ISY.
+#
+
+import time
+import random
+import socket
+import logging
+from threading import Thread,Lock,Event
+from urllib.parse import unquote
+from xml.sax.saxutils import escape
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+
+LOGGER = logging.getLogger(__name__)
+
+CONFIG = """<?xml version="1.0" encoding="UTF-8"?><configuration>
+<app_full_version>5.3.4</app_full_version>
+<root><id>00:21:b9:00:00:01</id><name>FakeISY</name></root>
+<product><id>1120</id><desc>ISY 994i</desc></product>
+<features><feature><id>21040</id><desc>Networking Module</desc><isInstalled>false</isInstalled></feature></features>
+<variables>true</variables><nodedefs>true</nodedefs>
+</configuration>"""
+
+CLOCK = """<?xml version="1.0" encoding="UTF-8"?><DT><NTP>3848400000</NTP><TMZOffset>-28800</TMZOffset><DST>true</DST>
+<Lat>38.0</Lat><Long>-122.0</Long><Sunrise>3848420000</Sunrise><Sunset>3848460000</Sunset><IsMilitary>false</IsMilitary></DT>"""
+
+OK = '<?xml version="1.0" encoding="UTF-8"?><RestResponse succeeded="true"><status>200</status></RestResponse>'
+
+class FakeISY():
+
+    def __init__(self,nodes=200,scenes=20,members=6,spoken=0.25,cmd_delay=0.0,seed=1,unknown=1):
+        """
+        nodes dimmers, scenes with members responders each plus one controller,
+        spoken is the fraction of nodes and scenes that have a Spoken note.
+        cmd_delay is how long a command takes, a real ISY takes 50-100 ms.
+        The first unknown nodes have not reported a status yet, the ISY sends
+        those as value=" ".
+        """
+        self.cmd_delay = cmd_delay
+        self.lock      = Lock()
+        self.random    = random.Random(seed)
+        # address: {'name', 'status', 'spoken'}, status None is unknown
+        self.nodes     = dict()
+        # address: {'name', 'members', 'controllers', 'spoken'}
+        self.scenes    = dict()
+        for i in range(nodes):
+            address = '{:02X} {:02X} {:02X} 1'.format((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+            self.nodes[address] = {
+                'name':   'Light {}'.format(i),
+                'status': None if i < unknown else 0,
+                'spoken': '1' if self.random.random() < spoken else None,
+            }
+        addresses = list(self.nodes)
+        for i in range(scenes):
+            lights = self.random.sample(addresses,min(len(addresses),members + 1))
+            self.scenes[str(10000 + i)] = {
+                'name':        'Scene {}'.format(i),
+                'members':     lights,
+                'controllers': lights[:1],
+                'spoken':      '1' if self.random.random() < spoken else None,
+            }
+        self.nodes_xml = self.build_nodes()
+        # Requests by type, and the time each command was received
+        self.requests  = dict()
+        self.commands  = []
+        self.streams   = []
+        self.seqnum    = 0
+        self.httpd     = None
+        self.running   = Event()
+
+    def load(self,nodes,scenes):
+        # Use the nodes and scenes of a recording instead of made up ones, see replay.py
+        self.nodes  = {address: dict(node,status=node['status'] if isinstance(node['status'],int) else 0) for address, node in nodes.items()}
+        self.scenes = {address: dict(scene,members=[member for member in scene['members'] if member in self.nodes],
+            controllers=[member for member in scene['controllers'] if member in self.nodes]) for address, scene in scenes.items()}
+        self.nodes_xml = self.build_nodes()
+
+    def spoken_count(self):
+        return len([1 for item in list(self.nodes.values()) + list(self.scenes.values()) if item['spoken'] is not None])
+
+    def build_nodes(self):
+        xml = ['<?xml version="1.0" encoding="UTF-8"?><nodes><root>FakeISY</root>']
+        for address, node in self.nodes.items():
+            xml.append('<node flag="128" nodeDefId="{}"><address>{}</address><name>{}</name>'
+                '<family>1</family><type>{}</type><enabled>true</enabled><pnode>{}</pnode>'
+                '<property id="ST" value="{}" formatted="" uom="100"/></node>'.format(node.get('node_def_id') or 'DimmerLampSwitch_ADV',
+                address,escape(node['name']),node.get('type') or '1.32.65.0',address,self.value(node['status'])))
+        for address, scene in self.scenes.items():
+            links = ''.join('<link type="{}">{}</link>'.format(16 if member in scene['controllers'] else 32,member) for member in scene['members'])
+            xml.append('<group flag="132" nodeDefId="InsteonDimmer"><address>{}</address><name>{}</name>'
+                '<family>6</family><members>{}</members></group>'.format(address,escape(scene['name']),links))
+        xml.append('</nodes>')
+        return ''.join(xml)
+
+    def status_xml(self):
+        with self.lock:
+            nodes = [(address,node['status']) for address, node in self.nodes.items()]
+        return '<?xml version="1.0" encoding="UTF-8"?><nodes>' + ''.join(
+            '<node id="{}"><property id="ST" value="{}" formatted="" uom="100"/></node>'.format(address,self.value(status)) for address, status in nodes
+        ) + '</nodes>'
+
+    @staticmethod
+    def value(status):
+        return ' ' if status is None else status
+
+    def notes_xml(self,address):
+        item = self.nodes.get(address) or self.scenes.get(address)
+        if item is None or item['spoken'] is None:
+            return None
+        return '<?xml version="1.0" encoding="UTF-8"?><NodeProperties><spoken>{}</spoken></NodeProperties>'.format(escape(item['spoken']))
+
+    #
+    # Commands and events
+    #
+    def command(self,address,cmd,value=None):
+        if self.cmd_delay > 0:
+            time.sleep(self.cmd_delay)
+        if cmd in ['DON', 'DFON']:
+            level = 255 if value is None else int(value)
+        elif cmd in ['DOF', 'DFOF']:
+            level = 0
+        elif cmd in ['FDUP', 'FDDOWN', 'FDSTOP']:
+            # The level isn't changed, the final level is always sent after a fade
+            level = None
+        else:
+            return False
+        self.commands.append((time.time(),address,cmd,value))
+        if address in self.scenes:
+            scene = self.scenes[address]
+            for member in scene['members']:
+                if member not in scene['controllers']:
+                    self.set_status(member,level)
+            return True
+        if address not in self.nodes:
+            return False
+        if level is not None:
+            self.set_status(address,level)
+        return True
+
+    def set_status(self,address,level):
+        with self.lock:
+            node = self.nodes[address]
+            if node['status'] == level:
+                return
+            node['status'] = level
+        self.event('ST',level,address)
+
+    def event(self,control,action,node=''):
+        with self.lock:
+            self.seqnum += 1
+            body = ('<?xml version="1.0"?><Event seqnum="{}" sid="uuid:1"><control>{}</control>'
+                '<action uom="100" prec="0">{}</action><node>{}</node><eventInfo></eventInfo></Event>').format(self.seqnum,control,action,node)
+            streams = list(self.streams)
+        message = 'POST reuse HTTP/1.1\r\nContent-Type: text/xml; charset="utf-8"\r\nContent-Length: {}\r\n\r\n{}'.format(len(body),body).encode('utf-8')
+        for stream in streams:
+            try:
+                with stream['lock']:
+                    stream['wfile'].write(message)
+                    stream['wfile'].flush()
+            except OSError:
+                with self.lock:
+                    if stream in self.streams:
+                        self.streams.remove(stream)
+
+    def heartbeat(self):
+        self.event('_0',120)
+
+    def random_events(self,count,addresses=None):
+        # Send count status changes to random nodes, returns the addresses changed.
+        if addresses is None:
+            addresses = list(self.nodes)
+        changed = []
+        for i in range(count):
+            address = self.random.choice(addresses)
+            with self.lock:
+                level = ((self.nodes[address]['status'] or 0) + 1 + self.random.randrange(254)) % 256
+            self.set_status(address,level)
+            changed.append(address)
+        return changed
+
+    #
+    # The HTTP server
+    #
+    def start(self,host='127.0.0.1',port=0):
+        isy = self
+
+        class FakeISYHandler(BaseHTTPRequestHandler):
+            # Keep-alive like the ISY, without Nagle holding the body for the delayed ACK
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                path = unquote(self.path.split('?')[0])
+                parts = [part for part in path.split('/') if part != '']
+                (status,body) = isy.get(parts)
+                what = parts[1] if len(parts) > 1 else path
+                with isy.lock:
+                    isy.requests[what] = isy.requests.get(what,0) + 1
+                data = body.encode('utf-8') if body is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type','text/xml; charset=UTF-8')
+                self.send_header('Content-Length',str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                # The event stream subscribe, the socket is kept for the events.
+                length = int(self.headers.get('Content-Length',0))
+                self.rfile.read(length)
+                if 'Subscribe' not in self.headers.get('SOAPAction',''):
+                    self.send_error(404)
+                    return
+                body = '<?xml version="1.0" encoding="UTF-8"?><Envelope><Body><SubscriptionResponse><SID>uuid:1</SID><duration>0</duration></SubscriptionResponse></Body></Envelope>'
+                self.wfile.write('HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n{}'.format(len(body),body).encode('utf-8'))
+                self.wfile.flush()
+                stream = {'wfile': self.wfile, 'lock': Lock()}
+                with isy.lock:
+                    isy.streams.append(stream)
+                isy.heartbeat()
+                isy.heartbeat()
+                # Keep the socket until the client closes it or the server stops.
+                self.connection.settimeout(1)
+                while isy.running.is_set():
+                    try:
+                        if self.connection.recv(1024) == b'':
+                            break
+                    except socket.timeout:
+                        continue
+                    except OSError:
+                        break
+                with isy.lock:
+                    if stream in isy.streams:
+                        isy.streams.remove(stream)
+                self.close_connection = True
+
+            def log_message(self,format,*args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host,port),FakeISYHandler)
+        self.httpd.daemon_threads = True
+        self.running.set()
+        thread = Thread(name='FakeISY',target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        LOGGER.info('FakeISY with {} nodes {} scenes on {}:{}'.format(len(self.nodes),len(self.scenes),host,self.port))
+        return self.port
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def stop(self):
+        self.running.clear()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def get(self,parts):
+        # Returns (status,body) for GET /rest/...
+        if len(parts) < 2 or parts[0] != 'rest':
+            return (404,None)
+        what = parts[1]
+        if what == 'ping':
+            return (200,OK)
+        if what == 'config':
+            return (200,CONFIG)
+        if what == 'time':
+            return (200,CLOCK)
+        if what == 'programs':
+            return (200,'<?xml version="1.0" encoding="UTF-8"?><programs></programs>')
+        if what == 'vars':
+            if len(parts) > 2 and parts[2] == 'definitions':
+                return (200,'<?xml version="1.0" encoding="UTF-8"?><CList type="VAR_INT"></CList>')
+            return (200,'<?xml version="1.0" encoding="UTF-8"?><vars></vars>')
+        if what == 'status':
+            return (200,self.status_xml())
+        if what == 'nodes':
+            if len(parts) == 2:
+                return (200,self.nodes_xml)
+            address = parts[2]
+            if len(parts) == 4 and parts[3] == 'notes':
+                notes = self.notes_xml(address)
+                return (404,None) if notes is None else (200,notes)
+            if len(parts) >= 5 and parts[3] == 'cmd':
+                value = parts[5] if len(parts) > 5 else None
+                return (200,OK) if self.command(address,parts[4],value) else (404,None)
+        return (404,None)
@@ -0,0 +1,125 @@
+#
+# The HueLoad object.
+#
+# A Hue client load generator for the benchmarks.  It polls like the Hue apps
+# do, discovery (description.xml and the short config) and full light lists,
+# and sends bursts of brightness PUTs like holding a dim button.  Each thread
+# keeps one keep-alive connection, and the latency of each request is kept by
+# the kind of request.
+#
+
+import json
+import time
+import logging
+import http.client
+from threading import Thread,Lock,local
+
+LOGGER = logging.getLogger(__name__)
+
+class HueLoad():
+
+    def __init__(self,host,port,user='bench'):
+        self.host      = host
+        self.port      = port
+        self.user      = user
+        self.lock      = Lock()
+        self.local     = local()
+        # kind: [latency seconds]
+        self.latencies = dict()
+        self.errors    = 0
+
+    def request(self,kind,method,path,body=None):
+        conn = getattr(self.local,'conn',None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection(self.host,self.port,timeout=10)
+        # A str body is sent as is, like a recorded one
+        data = body if body is None or isinstance(body,str) else json.dumps(body)
+        st = time.time()
+        try:
+            conn.request(method,path,body=data,headers={'Content-Type': 'application/json'} if data else {})
+            response = conn.getresponse()
+            result = response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException) as ex:
+            LOGGER.debug('{} {} failed: {}'.format(method,path,ex))
+            conn.close()
+            self.local.conn = None
+            result = None
+            ok = False
+        with self.lock:
+            self.latencies.setdefault(kind,[]).append(time.time() - st)
+            if not ok:
+                self.errors += 1
+        return result
+
+    def discovery(self):
+        self.request('discovery','GET','/description.xml')
+        self.request('discovery','GET','/api/config')
+
+    def full_list(self):
+        return self.request('full_list','GET','/api/{}/lights'.format(self.user))
+
+    def put(self,light,data):
+        return self.request('put','PUT','/api/{}/lights/{}/state'.format(self.user,light),data)
+
+    def put_burst(self,lights,count,interval=0.02):
+        """
+        Send count brightness changes to each light, like holding a dim button
+        on each of them at the same time.  Returns the last brightness sent to each light.
+        """
+        last = dict()
+
+        def burst(light):
+            for i in range(count):
+                bri = 1 + (i * 37 + int(light) * 11) % 254
+                self.put(light,{'on': True, 'bri': bri})
+                last[light] = bri
+                if interval > 0:
+                    time.sleep(interval)
+
+        threads = [Thread(name='HueBurst{}'.format(light),target=burst,args=(light,)) for light in lights]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return last
+
+    def run(self,duration=3.0,concurrency=4,discovery=1,full_list=4):
+        """
+        Poll with concurrency threads for duration seconds, each thread does
+        discovery and full_list requests in that ratio.
+        """
+        end = time.time() + duration
+
+        def poll():
+            while time.time() < end:
+                for i in range(discovery):
+                    self.discovery()
+                for i in range(full_list):
+                    self.full_list()
+
+        threads = [Thread(name='HueLoad{}'.format(i),target=poll) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def reset(self):
+        with self.lock:
+            self.latencies = dict()
+            self.errors    = 0
+
+    def get_stats(self,kind,duration=None):
+        # Count, p50 and p99 in ms, and requests per second when duration is given.
+        with self.lock:
+            latencies = sorted(self.latencies.get(kind,[]))
+        if len(latencies) == 0:
+            return {'count': 0}
+        stats = {
+            'count':  len(latencies),
+            'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+            'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 2),
+        }
+        if duration:
+            stats['per_s'] = round(len(latencies) / duration, 1)
+        return stats
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the Hue Emulator, using a FakeISY and the HueLoad
+Hue client instead of a real ISY and Hue apps.
+
+Run from the top of the nodeserver directory:
+    python3 bench/bench.py                  Run and compare with bench/baseline.json
+    python3 bench/bench.py --save           Run and save as the new baseline
+    python3 bench/bench.py --nodes 2000 --scenes 200 --cmd-delay 0.05
+    python3 bench/bench.py --hue-server asyncio   Compare the asyncio Hue server with the baseline
+
+Scenarios:
+    connect   Start ISYHueEmu with the --hue-server Hue server, time until all lights are served
+    refresh   ISYHueEmu.refresh() with all notes cached, and with none cached
+    events    ISY status events for spoken devices, throughput and delay to the Hue state
+    commands  Bursts of Hue brightness PUTs, Hue and ISY command latency and time to settle
+    hue_load  Discovery and full light list polls from several clients
+    ssdp      A flood of M-SEARCH requests to an SSDPResponder on loopback
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import platform
+import argparse
+import tempfile
+import threading
+from threading import Thread
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR  = os.path.dirname(BENCH_DIR)
+sys.path.insert(0,BENCH_DIR)
+sys.path.insert(0,ROOT_DIR)
+# ISYHueEmu adds hue-upnp relative to the current directory, which is changed below.
+sys.path.insert(0,os.path.join(ROOT_DIR,'hue-upnp'))
+
+from FakeISY import FakeISY
+from HueLoad import HueLoad
+from SSDPResponder import SSDPResponder
+
+LOGGER = logging.getLogger('bench')
+
+# Results where a higher value is better, and the suffixes of times where
+# lower is.  Other results are counts which are not better or worse.
+HIGHER_IS_BETTER = ['per_s']
+TIME_SUFFIXES    = ['_ms', '_us', '_s']
+
+def free_port():
+    sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1',0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_for(check,timeout=60.0,interval=0.01):
+    # Returns the seconds until check() was True, or None on timeout
+    st = time.time()
+    while time.time() - st < timeout:
+        if check():
+            return time.time() - st
+        time.sleep(interval)
+    return None
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+class Bench():
+
+    def __init__(self,args):
+        self.args    = args
+        self.results = dict()
+        self.isy     = FakeISY(nodes=args.nodes,scenes=args.scenes,spoken=args.spoken,cmd_delay=args.cmd_delay)
+        self.emu     = None
+        self.thread  = None
+
+    def run(self):
+        from ISYHueEmu import ISYHueEmu
+        isy_port = self.isy.start()
+        hue_port = free_port()
+        self.hue = HueLoad('127.0.0.1',hue_port)
+        self.emu = ISYHueEmu('127.0.0.1',hue_port,'127.0.0.1',isy_port,'admin','admin',options={
+            'hue_server': self.args.hue_server,
+            'warm_start': False,
+            'metrics': False,
+            'notes_recheck_time': 0,
+            'coalesce_window': self.args.coalesce_window,
+        })
+        try:
+            self.connect()
+            self.refresh()
+            self.events()
+            self.commands()
+            self.hue_load()
+            self.ssdp()
+        finally:
+            # pyisy's event thread can fail reading the socket it just closed when stopping,
+            # and its __del__ can fail to unsubscribe a stream that is already gone.
+            threading.excepthook = lambda args: None
+            sys.unraisablehook = lambda args: None
+            self.emu.stop()
+            if self.thread is not None:
+                self.thread.join(5)
+            self.isy.stop()
+        return self.results
+
+    def lights(self):
+        data = self.hue.full_list()
+        return dict() if data is None else json.loads(data)
+
+    def connect(self):
+        expected = self.isy.spoken_count()
+        st = time.time()
+        self.thread = Thread(name='ConnectISY',target=self.emu.connect,args=(True,))
+        self.thread.daemon = True
+        self.thread.start()
+        # Requests fail until the Hue server is started
+        seconds = wait_for(lambda: len(self.lights()) >= expected, interval=0.02)
+        if seconds is None:
+            raise RuntimeError('Only {} of {} lights after connect'.format(len(self.lights()),expected))
+        connect_s = time.time() - st
+        self.hue.reset()
+        wait_for(lambda: 'total' in self.emu.phases)
+        self.results['connect'] = {
+            'lights':  expected,
+            'connect_s': round(connect_s, 3),
+            'phases': dict(self.emu.phases),
+            'isy_requests': dict(self.isy.requests),
+        }
+        LOGGER.info('connect: {}'.format(self.results['connect']))
+
+    def refresh(self):
+        warm = []
+        for i in range(self.args.repeat):
+            st = time.time()
+            self.emu.refresh()
+            warm.append(time.time() - st)
+        # None cached, like the first start
+        self.emu.notes_cache.notes.clear()
+        st = time.time()
+        self.emu.refresh()
+        cold = time.time() - st
+        self.results['refresh'] = {
+            'warm_s': round(sorted(warm)[len(warm) // 2], 4),
+            'cold_s': round(cold, 4),
+        }
+        LOGGER.info('refresh: {}'.format(self.results['refresh']))
+
+    def handlers(self):
+        return [device for device in self.emu.pdevices if device is not False and not device.is_scene]
+
+    def events(self):
+        addresses = [device.id for device in self.handlers()]
+        metrics = self.emu.metrics
+        before = metrics.get_count('isy_events_total')
+        count = self.args.events
+        st = time.time()
+        self.isy.random_events(count,addresses)
+        seconds = wait_for(lambda: metrics.get_count('isy_events_total') >= before + count, timeout=120)
+        if seconds is None:
+            LOGGER.error('Only {} of {} events received'.format(metrics.get_count('isy_events_total') - before,count))
+        seconds = time.time() - st
+        self.results['events'] = {
+            'count':    count,
+            'per_s':    round(count / seconds, 1),
+            'delay_p50_ms': ms(metrics.get_quantile('isy_event_delay_seconds',0.5)),
+            'delay_p99_ms': ms(metrics.get_quantile('isy_event_delay_seconds',0.99)),
+        }
+        LOGGER.info('events: {}'.format(self.results['events']))
+
+    def commands(self):
+        handlers = self.handlers()[:self.args.burst_lights]
+        lights = {str(device.index + 1): device for device in handlers}
+        self.hue.reset()
+        before = dict(self.emu.stats()['commands'])
+        last = self.hue.put_burst(list(lights),self.args.burst)
+        settle = wait_for(lambda: all(self.isy.nodes[lights[light].id]['status'] == bri for light, bri in last.items()), timeout=120)
+        commands = self.emu.stats()['commands']
+        dispatch = self.emu.dispatcher.get_stats()
+        self.results['commands'] = {
+            'puts':         self.hue.get_stats('put')['count'],
+            'put_p50_ms':   self.hue.get_stats('put').get('p50_ms'),
+            'put_p99_ms':   self.hue.get_stats('put').get('p99_ms'),
+            'sent':         commands['sent'] - before['sent'],
+            'coalesced':    commands['coalesced'] - before['coalesced'],
+            'isy_cmd_p50_ms': ms(self.emu.metrics.get_quantile('isy_command_seconds',0.5)),
+            'isy_cmd_p99_ms': ms(self.emu.metrics.get_quantile('isy_command_seconds',0.99)),
+            'dispatch_p50_ms': dispatch.get('latency_p50_ms'),
+            'dispatch_p99_ms': dispatch.get('latency_p99_ms'),
+            'settle_s':     None if settle is None else round(settle, 3),
+        }
+        LOGGER.info('commands: {}'.format(self.results['commands']))
+
+    def hue_load(self):
+        self.hue.reset()
+        duration = self.args.duration
+        self.hue.run(duration=duration,concurrency=self.args.clients)
+        self.results['hue_load'] = {
+            'clients':   self.args.clients,
+            'discovery': self.hue.get_stats('discovery',duration),
+            'full_list': self.hue.get_stats('full_list',duration),
+            'errors':    self.hue.errors,
+        }
+        LOGGER.info('hue_load: {}'.format(self.results['hue_load']))
+
+    def ssdp(self):
+        # Each source is a different loopback address so the rate limit is per source.
+        responder = SSDPResponder(self.emu.hue_server.apis,self.emu.options['ssdp_rate'],port=0,multicast=False)
+        responder.start('127.0.0.1')
+        targets = ['ssdp:all', 'upnp:rootdevice', 'urn:schemas-upnp-org:device:basic:1', 'urn:dial-multiscreen-org:service:dial:1']
+        sources = []
+        for i in range(self.args.ssdp_sources):
+            sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.{}'.format(2 + i),0))
+            sock.settimeout(0.5)
+            sources.append(sock)
+        replies = [0]
+
+        def receive(sock):
+            while True:
+                try:
+                    sock.recvfrom(2048)
+                except OSError:
+                    break
+                replies[0] += 1
+
+        def flood(sock):
+            for i in range(self.args.ssdp_searches):
+                search = 'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"\r\nMX: 1\r\nST: {}\r\n\r\n'.format(targets[i % len(targets)])
+                sock.sendto(search.encode('utf-8'),('127.0.0.1',responder.port))
+
+        receivers = [Thread(target=receive,args=(sock,)) for sock in sources]
+        for thread in receivers:
+            thread.start()
+        senders = [Thread(target=flood,args=(sock,)) for sock in sources]
+        for thread in senders:
+            thread.start()
+        for thread in senders:
+            thread.join()
+        sent = len(sources) * self.args.ssdp_searches
+        # Packets the socket buffer could not hold are dropped, so wait until no more arrive.
+        received = -1
+        while received != responder.stats['received']:
+            received = responder.stats['received']
+            time.sleep(0.2)
+        for thread in receivers:
+            thread.join()
+        responder.stop()
+        for sock in sources:
+            sock.close()
+        stats = responder.stats
+        # How fast a search is handled without the socket, a new address each time so none are suppressed
+        search = b'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"\r\nMX: 1\r\nST: ssdp:all\r\n\r\n'
+        handler = SSDPResponder(self.emu.hue_server.apis,self.emu.options['ssdp_rate'],port=0,multicast=False)
+        st = time.time()
+        for i in range(10000):
+            handler.handle(search,('10.{}.{}.{}'.format(i >> 16,(i >> 8) & 255,i & 255),1900))
+        self.results['ssdp'] = {
+            'sent':         sent,
+            'received':     stats['received'],
+            'handle_us':    round((time.time() - st) * 100, 2),
+            'answered':     stats['answered'],
+            'suppressed':   stats['duplicate'] + stats['rate_limited'],
+            'other':        stats['other'],
+            'replies':      replies[0],
+        }
+        LOGGER.info('ssdp: {}'.format(self.results['ssdp']))
+
+def flatten(results,prefix=''):
+    # {'a': {'b': 1}} -> {'a.b': 1} for the numbers only
+    values = dict()
+    for key, value in results.items():
+        if isinstance(value,dict):
+            values.update(flatten(value,prefix + key + '.'))
+        elif isinstance(value,(int,float)) and not isinstance(value,bool):
+            values[prefix + key] = value
+    return values
+
+def compare(baseline,results):
+    old = flatten(baseline['results'])
+    new = flatten(results)
+    print('{:40} {:>12} {:>12} {:>8}'.format('', 'baseline', 'now', 'change'))
+    for key in sorted(new):
+        if key not in old or old[key] in [0, None]:
+            print('{:40} {:>12} {:>12}'.format(key, '', new[key]))
+            continue
+        change = (new[key] - old[key]) / old[key] * 100
+        name = key.split('.')[-1]
+        if name in HIGHER_IS_BETTER:
+            better = change > 0
+        elif any(name.endswith(suffix) for suffix in TIME_SUFFIXES):
+            better = change < 0
+        else:
+            better = None
+        verdict = '' if better is None or abs(change) < 10 else ('better' if better else 'worse')
+        print('{:40} {:>12} {:>12} {:>7.1f}% {}'.format(key, old[key], new[key], change, verdict))
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline Hue Emulator benchmarks')
+    parser.add_argument('--nodes', type=int, default=1000, help='ISY nodes')
+    parser.add_argument('--scenes', type=int, default=100, help='ISY scenes')
+    parser.add_argument('--spoken', type=float, default=0.25, help='Fraction of nodes and scenes with a Spoken note')
+    parser.add_argument('--cmd-delay', type=float, default=0.0, help='Seconds the FakeISY takes for a command')
+    parser.add_argument('--hue-server', default='native', choices=['native', 'asyncio'], help='ISYHueEmu hue_server')
+    parser.add_argument('--coalesce-window', type=float, default=0.3, help='ISYHueEmu coalesce_window')
+    parser.add_argument('--repeat', type=int, default=3, help='Warm refresh runs')
+    parser.add_argument('--events', type=int, default=2000, help='ISY status events to send')
+    parser.add_argument('--burst', type=int, default=10, help='PUTs per light in a burst')
+    parser.add_argument('--burst-lights', type=int, default=10, help='Lights in a burst')
+    parser.add_argument('--clients', type=int, default=4, help='Hue clients polling')
+    parser.add_argument('--duration', type=float, default=3.0, help='Seconds the Hue clients poll')
+    parser.add_argument('--ssdp-sources', type=int, default=20, help='Addresses sending M-SEARCH requests')
+    parser.add_argument('--ssdp-searches', type=int, default=500, help='M-SEARCH requests from each address')
+    parser.add_argument('--baseline', default=os.path.join(BENCH_DIR,'baseline.json'), help='Baseline file')
+    parser.add_argument('--save', action='store_true', help='Save the results as the baseline')
+    parser.add_argument('--verbose', action='store_true', help='Log the benchmark progress')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.verbose:
+        LOGGER.setLevel(logging.INFO)
+
+    # ISYHueEmu writes config/config.json in the current directory
+    os.chdir(tempfile.mkdtemp(prefix='hue-emu-bench-'))
+    os.mkdir('config')
+    results = Bench(args).run()
+    params = {key: value for key, value in vars(args).items() if key not in ['baseline', 'save', 'verbose']}
+    if args.save:
+        with open(args.baseline,'w') as fh:
+            json.dump({
+                'date':    time.strftime('%Y-%m-%d'),
+                'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+                'params':  params,
+                'results': results,
+            }, fh, indent=2, sort_keys=True)
+            fh.write('\n')
+        print('Saved baseline {}'.format(args.baseline))
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if baseline['params'] != params:
+            print('Baseline params are different: {}'.format(baseline['params']))
+        compare(baseline,results)
+    else:
+        print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Replay a recording made with the record option against ISYHueEmu and a
+FakeISY with the same nodes and scenes, and report how it kept up.
+
+Run from the top of the nodeserver directory:
+    python3 bench/replay.py config/record-20240101-120000.jsonl.gz
+    python3 bench/replay.py --speed 10 record.jsonl.gz         Ten times faster than recorded
+    python3 bench/replay.py --speed 0 --hue-server asyncio record.jsonl.gz   As fast as possible
+
+The ISY events are sent by the FakeISY at the recorded times, and the Hue
+requests are sent by HueLoad to the same bridge.  Light and group ids are
+changed to the ids the devices have in the replay.  At the end the Hue state
+of each device is compared with the state when the recording ended, the exit
+status is 1 when any are different.
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,BENCH_DIR)
+from bench import free_port,wait_for,ms
+from FakeISY import FakeISY
+from HueLoad import HueLoad
+from HueApi import HueApi
+
+LOGGER = logging.getLogger('replay')
+
+def load(path):
+    # Returns (header,items,end), end is None when the recording was not closed.
+    with gzip.open(path,'rt',encoding='utf-8') as fh:
+        lines = [json.loads(line) for line in fh if line.strip() != '']
+    header = lines.pop(0)
+    if header.get('recording') != 1:
+        raise ValueError('{} is not a recording this replay understands'.format(path))
+    end = lines.pop() if len(lines) > 0 and isinstance(lines[-1],dict) else None
+    return (header,lines,end)
+
+class Replay():
+
+    def __init__(self,args):
+        self.args   = args
+        (self.header,self.items,self.end) = load(args.recording)
+        self.isy    = FakeISY(nodes=0,scenes=0,cmd_delay=args.cmd_delay)
+        self.isy.load(self.header['nodes'],self.header['scenes'])
+        self.emu    = None
+        self.thread = None
+        self.hues   = dict()
+        # recorded light and group ids to the ids in the replay
+        self.ids    = {'lights': dict(), 'groups': dict()}
+        self.lag    = []
+        self.skipped = 0
+
+    def run(self):
+        from ISYHueEmu import ISYHueEmu
+        options = dict(self.header['options'],warm_start=False,notes_recheck_time=0,metrics=False)
+        if self.args.hue_server is not None:
+            options['hue_server'] = self.args.hue_server
+        elif options['hue_server'] not in ['native', 'asyncio']:
+            options['hue_server'] = 'native'
+        isy_port = self.isy.start()
+        self.emu = ISYHueEmu('127.0.0.1',free_port(),'127.0.0.1',isy_port,'admin','admin',options=options)
+        try:
+            self.connect()
+            results = self.replay()
+            results['states'] = self.check()
+        finally:
+            # Same as bench.py, pyisy can fail in its threads while stopping.
+            threading.excepthook = lambda args: None
+            sys.unraisablehook = lambda args: None
+            self.emu.stop()
+            if self.thread is not None:
+                self.thread.join(5)
+            self.isy.stop()
+        return results
+
+    def connect(self):
+        self.thread = Thread(name='ConnectISY',target=self.emu.connect,args=(True,))
+        self.thread.daemon = True
+        self.thread.start()
+        if wait_for(lambda: 'total' in self.emu.phases) is None:
+            raise RuntimeError('ISYHueEmu did not start')
+        for shard in range(self.emu.bridges()):
+            self.hues[shard] = HueLoad('127.0.0.1',self.emu.bridge_port(shard),'replay')
+        indexes = {device.id: device.index for device in self.emu.pdevices if device is not False}
+        for address, index in self.header['devices'].items():
+            if address in indexes:
+                self.ids['lights'][str(index + 1)] = str(indexes[address] + 1)
+        indexes = {group.id: group.index for group in self.emu.groups if group is not False}
+        for address, index in self.header['groups'].items():
+            if address in indexes:
+                self.ids['groups'][str(index + 1)] = str(indexes[address] + 1)
+        LOGGER.info('Replaying {} devices, {} groups, phases={}'.format(len(self.ids['lights']),len(self.ids['groups']),self.emu.phases))
+
+    def path(self,path):
+        # /api/<user>/lights/<id>/... with the id in the replay
+        parts = path.split('/')
+        if len(parts) > 4 and parts[1] == 'api' and parts[3] in self.ids:
+            parts[4] = self.ids[parts[3]].get(parts[4],parts[4])
+        return '/'.join(parts)
+
+    def request(self,shard,method,path,body):
+        hue = self.hues.get(shard)
+        if hue is None:
+            self.skipped += 1
+            return
+        hue.request(method + ' ' + HueApi.endpoint(path.split('?')[0]),method,self.path(path),body or None)
+
+    def replay(self):
+        speed   = self.args.speed
+        metrics = self.emu.metrics
+        before  = metrics.get_count('isy_events_total')
+        commands = len(self.isy.commands)
+        counts  = {'e': 0, 'h': 0}
+        executor = ThreadPoolExecutor(max_workers=self.args.clients,thread_name_prefix='Replay')
+        st = time.time()
+        for item in self.items:
+            if speed > 0:
+                at = st + item[0] / speed
+                wait = at - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                self.lag.append(max(0,time.time() - at))
+            if item[1] == 'e':
+                (address,status) = item[2:4]
+                if address in self.isy.nodes and isinstance(status,int):
+                    counts['e'] += 1
+                    self.isy.set_status(address,status)
+                else:
+                    # Scene status follows its members
+                    self.skipped += 1
+            else:
+                counts['h'] += 1
+                executor.submit(self.request,*item[2:6])
+        executor.shutdown(wait=True)
+        seconds = time.time() - st
+        # Until the last commands are sent
+        coalescers = [device.coalescer for device in self.emu.pdevices if hasattr(device,'coalescer')]
+        wait_for(lambda: self.emu.dispatcher.depth == 0 and all(coalescer.pending is None for coalescer in coalescers),timeout=30)
+        lag = sorted(self.lag)
+        hue = dict()
+        for shard in self.hues.values():
+            for kind in list(shard.latencies):
+                hue[kind] = shard.get_stats(kind,seconds)
+        return {
+            'recording': {
+                'seconds':  self.end['end'] if self.end is not None else (self.items[-1][0] if self.items else 0),
+                'events':   len([1 for item in self.items if item[1] == 'e']),
+                'requests': len([1 for item in self.items if item[1] == 'h']),
+            },
+            'replay': {
+                'speed':      speed,
+                'seconds':    round(seconds, 3),
+                'events':     metrics.get_count('isy_events_total') - before,
+                'events_per_s': round(counts['e'] / seconds, 1) if seconds > 0 else None,
+                'requests_per_s': round(counts['h'] / seconds, 1) if seconds > 0 else None,
+                'lag_p99_ms': ms(lag[min(len(lag) - 1, int(len(lag) * 0.99))]) if lag else None,
+                'lag_max_ms': ms(lag[-1]) if lag else None,
+                'skipped':    self.skipped,
+            },
+            'event_delay': {
+                'p50_ms': ms(metrics.get_quantile('isy_event_delay_seconds',0.5)),
+                'p99_ms': ms(metrics.get_quantile('isy_event_delay_seconds',0.99)),
+            },
+            'hue':          hue,
+            'isy_commands': len(self.isy.commands) - commands,
+            'commands':     self.emu.stats()['commands'],
+        }
+
+    def check(self):
+        # Compare the Hue state of each device with the end of the recording
+        if self.end is None:
+            LOGGER.warning('The recording was not closed, no final states to check')
+            return None
+        expected = self.end['states']
+        devices = {device.id: device for device in self.emu.pdevices if device is not False}
+
+        def mismatches():
+            ret = []
+            for address, state in expected.items():
+                device = devices.get(address)
+                if device is None:
+                    ret.append({'id': address, 'recorded': state, 'replay': None})
+                    continue
+                (on,bri) = self.emu.state.get(device.index)
+                if [on == "true", int(bri)] != state:
+                    ret.append({'id': address, 'name': device.name, 'recorded': state, 'replay': [on == "true", int(bri)]})
+            return ret
+
+        # Give the last commands and events time to arrive
+        wait_for(lambda: len(mismatches()) == 0,timeout=self.args.settle)
+        different = mismatches()
+        return {'devices': len(expected), 'different': len(different), 'examples': different[:10]}
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a Hue Emulator recording')
+    parser.add_argument('recording', help='The record-<time>.jsonl.gz file from the config folder')
+    parser.add_argument('--speed', type=float, default=1.0, help='Times faster than recorded, 0 for as fast as possible')
+    parser.add_argument('--hue-server', default=None, choices=['native', 'asyncio'], help='ISYHueEmu hue_server, default is the recorded one')
+    parser.add_argument('--cmd-delay', type=float, default=0.0, help='Seconds the FakeISY takes for a command')
+    parser.add_argument('--clients', type=int, default=8, help='Hue requests sent at the same time')
+    parser.add_argument('--settle', type=float, default=10.0, help='Max seconds to wait for the final states')
+    parser.add_argument('--verbose', action='store_true', help='Log the replay progress')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.verbose:
+        LOGGER.setLevel(logging.INFO)
+    args.recording = os.path.abspath(args.recording)
+
+    # ISYHueEmu writes config/ in the current directory
+    os.chdir(tempfile.mkdtemp(prefix='hue-emu-replay-'))
+    os.mkdir('config')
+    results = Replay(args).run()
+    print(json.dumps(results, indent=2))
+    if results['states'] is not None and results['states']['different'] > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
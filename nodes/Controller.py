@@ -7,22 +7,52 @@ from udi_interface import Node,LOGGER,Custom,LOG_HANDLER
 import sys
 import time
 import logging
-import pyisy
 from ISYHueEmu import ISYHueEmu
+from SpokenTable import SpokenTable
 from traceback import format_exception
-from threading import Thread
+from threading import Thread,Event
+
+# The loggers of hueUpnp and the emulator modules, handler_log_level sets them to the level picked.
+EMULATOR_LOGGERS = (
+    'hueUpnp', 'ISYHueEmu', 'NotesCache', 'HueState', 'CommandCoalescer',
+    'ISYDispatcher', 'HueApi', 'HueServer', 'AsyncHueServer', 'SceneState',
+    'ISYSession', 'ISYSupervisor', 'Metrics', 'SpokenTable', 'DeviceRegistry',
+    'DeviceClassifier', 'Transition', 'Recorder', 'SSDPResponder',
+)
 
 class Controller(Node):
 
     # Number of longPoll calls to timeout listen
     LISTEN_TIMEOUT = 5
+    # Seconds to wait for the start and params handlers after config done
+    READY_TIMEOUT = 60
+    # What has to start again when a param changes, any param not here restarts everything.
+    #   hue:     Only the Hue server, with the current devices
+    #   isy:     Only the ISY connection, the Hue server keeps answering
+    #   options: Nothing, the option is used as it is
+    PARAM_PHASES = {
+        'hue_port':       'hue',
+        'hue_server':     'hue',
+        'hue_workers':    'hue',
+        'ssdp_rate':      'hue',
+        'isy_host':       'isy',
+        'isy_port':       'isy',
+        'isy_user':       'isy',
+        'isy_password':   'isy',
+        'record':         'options',
+        'docs_interval':  'options',
+        'docs_max_rows':  'options',
+    }
 
     def __init__(self, poly, primary, address, name):
         LOGGER.info('Initializing')
+        self.init_time = time.time()
         self.isy_hue_emu = False
         self.restarting  = True
         self.first_run = True
         self.sent_cstr = ""
+        self.sent_time = 0
+        self.spoken_table = SpokenTable()
         self.thread = None
         self.hb = 0
         self.listen_cnt = Controller.LISTEN_TIMEOUT
@@ -37,6 +67,13 @@ class Controller(Node):
         self.handler_start_st      = None
         self.handler_config_st     = None
         self.handler_params_st     = None
+        # Set when handler_start and handler_params are done, handler_config_done waits for them
+        self.started_event         = Event()
+        self.params_event          = Event()
+        # The params of the running ISYHueEmu, to know what changed
+        self.running_params        = None
+        # Seconds from starting until Polyglot sent the config
+        self.polyglot_s            = None
         super(Controller, self).__init__(poly, primary, address, name)
         self.Notices.clear()
         poly.ready()
@@ -49,6 +86,7 @@ class Controller(Node):
         self.net_ifc = self.poly.getNetworkInterface()
         self.heartbeat()
         self.handler_start_st = True
+        self.started_event.set()
         LOGGER.info('done')
 
     def handler_config_done(self):
@@ -59,18 +97,12 @@ class Controller(Node):
         self.poly.addLogLevel('DEBUG_MODULES_VERBOSE',9,'Debug + Modules')
         # This is supposed to only run after we have received and
         # processed all config data, just add a check here.
-        cnt = 60
-        while ((self.handler_start_st is None
-            or self.handler_params_st is None)
-            and cnt > 0
-        ):
-            LOGGER.warning(f'Waiting for all handlers to complete start={self.handler_start_st} params={self.handler_params_st} cnt={cnt}')
-            time.sleep(1)
-            cnt -= 1
-        if cnt == 0:
-            LOGGER.error('Timed out waiting for all handlers to complete')
+        if not self.wait_ready(Controller.READY_TIMEOUT):
+            LOGGER.error(f'Timed out waiting for all handlers to complete start={self.handler_start_st} params={self.handler_params_st}')
             self.poly.stop()
             return
+        self.polyglot_s = round(time.time() - self.init_time,3)
+        LOGGER.info(f'Startup: Polyglot config done {self.polyglot_s} seconds after start')
         if self.handler_params_st:
             self.connect()
         else:
@@ -79,6 +111,16 @@ class Controller(Node):
         self.first_run = False
         LOGGER.debug("exit")
 
+    def wait_ready(self,timeout):
+        # Wait for the start and params handlers, returns False if they are not done in time.
+        st = time.time()
+        for (name,event) in [('start',self.started_event), ('params',self.params_event)]:
+            if not event.is_set():
+                LOGGER.warning(f'Waiting for the {name} handler to complete')
+            if not event.wait(max(0,timeout - (time.time() - st))):
+                return False
+        return True
+
     def handler_poll(self, polltype):
         if self.restarting:
             LOGGER.warning("no polling when restarting...")
@@ -90,6 +132,9 @@ class Controller(Node):
 
     def shortPoll(self):
         self.update_config_docs()
+        if self.thread is not None:
+            # The ISY connection can be lost and made again while the thread is running.
+            self.set_isy_connected()
         if self.thread is not None:
             if not self.thread.is_alive():
                 self.thread = None
@@ -100,6 +145,10 @@ class Controller(Node):
         self.heartbeat()
         if self.initializing:
             return
+        if self.isy_hue_emu is not False:
+            self.isy_hue_emu.save_state()
+            LOGGER.info('stats: {}'.format(self.isy_hue_emu.stats()))
+            self.set_summary(self.isy_hue_emu.summary())
         if self.get_listen() == 1:
             LOGGER.warning('Listen Count = {}'.format(self.listen_cnt))
             if self.listen_cnt > 0:
@@ -135,42 +184,22 @@ class Controller(Node):
             LOGGER.error('No Hue Emulator?')
             return
         self.isy_hue_emu.refresh()
-        self.update_config_docs()
+        self.update_config_docs(force=True)
 
-    def update_config_docs(self):
-        # '<style> table { cellpadding: 10px } </style>'
-        self.config_info = [
-        '<h1>Spoken Device Table</h1>',
-        'This table is refreshed during short poll, so it may be out of date for a few seconds<br>',
-        '<table border=1>',
-        '<tr><th colspan=2><center>Hue<th rowspan=2><center>NSId<th colspan=2><center>Property Node/Scene<th colspan=3><center>Scene<th rowspan=2><center>Spoken<th rowspan=2><center>On<th rowspan=2><center>Bri</tr>',
-        '<tr><th><center>Id<th><center>Type<th><center>Id<th><center>NodeDefId<th><center>Name<th><center>Scene<th><center>Name<th></tr>']
-        if self.isy_hue_emu is not False:
-            for i, device in enumerate(self.isy_hue_emu.pdevices):
-                # Only used for debug
-                if device is False:
-                    dtype = 'None'
-                elif device.node.protocol == pyisy.constants.PROTO_GROUP:
-                    dtype = 'Scene'
-                else:
-                    dtype = device.node.node_def_id
-                if device is False:
-                    self.config_info.append('<tr><td>{}<td colspan=9>empty</tr>'.format(i))
-                elif device.scene is False:
-                    self.config_info.append('<tr><td>{}<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td colspan=2>&nbsp;None&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;</tr>'.
-                    format(i,device.type,device.id,device.node,dtype,device.node.name,device.name,device.on,device.bri))
-                else:
-                    self.config_info.append('<tr><td>&nbsp;{}&nbsp;<td>{}<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;<td>&nbsp;{}&nbsp;</tr>'.
-                    format(i,device.type,device.id,device.node,dtype,device.node.name,device.scene,device.scene.name,device.name,device.on,device.bri))
-        self.config_info.append('</table>')
-        s = "\n"
-        #
-        # Set the Custom Config Doc when it changes
-        #
-        cstr = s.join(self.config_info)
-        if self.sent_cstr != cstr:
-            self.poly.setCustomParamsDoc(cstr)
-            self.sent_cstr = cstr
+    def update_config_docs(self,force=False):
+        # The table only changes when a device does, and is set at most every docs_interval seconds.
+        if self.isy_hue_emu is False:
+            options = ISYHueEmu.default_options
+        else:
+            options = self.isy_hue_emu.options
+        cstr = self.spoken_table.get_html(self.isy_hue_emu,options['docs_max_rows'])
+        if cstr is self.sent_cstr:
+            return
+        if not force and time.time() - self.sent_time < options['docs_interval']:
+            return
+        self.poly.setCustomParamsDoc(cstr)
+        self.sent_cstr = cstr
+        self.sent_time = time.time()
 
     def stop_thread(self):
         if self.thread is not None and self.thread.is_alive():
@@ -186,6 +215,7 @@ class Controller(Node):
         LOGGER.info('Starting thread for ISYHueEmu')
         self.restarting = False
 
+        self.running_params = self.get_params()
         # TODO: Can we get the ISY info from Polyglot?  If not, then document these
         self.isy_hue_emu = ISYHueEmu(
             self.net_ifc['addr'],
@@ -194,7 +224,10 @@ class Controller(Node):
             self.isy_port,
             self.isy_user,
             self.isy_password,
+            options=self.options,
             )
+        if self.polyglot_s is not None:
+            self.isy_hue_emu.phases['polyglot'] = self.polyglot_s
         self.client_status = "init"
         self.thread = Thread(name='ConnectISY',target=self._connect)
         self.thread.daemon = True
@@ -248,12 +281,53 @@ class Controller(Node):
         self.isy_port = data['isy_port']
         self.isy_user = data['isy_user']
         self.isy_password = data['isy_password']
+        # Optional tuning params, ISYHueEmu uses it's default when not defined.
+        self.options = {}
+        for param in ISYHueEmu.default_options:
+            if param in data and data[param] != "":
+                self.options[param] = data[param]
 
         # Don't call connect on first run, handler_config_done will doe it
         if not self.first_run:
-            self.connect()
+            self.restart()
 
         self.handler_params_st = st
+        self.params_event.set()
+
+    def get_params(self):
+        # The params and options the ISYHueEmu is started with
+        params = {'hue_port': self.hue_port, 'isy_host': self.isy_host, 'isy_port': self.isy_port, 'isy_user': self.isy_user, 'isy_password': self.isy_password}
+        params.update(self.options)
+        return params
+
+    def restart(self):
+        """
+        Start again only what the changed params need, see PARAM_PHASES.
+        """
+        params = self.get_params()
+        old = self.running_params
+        if self.isy_hue_emu is False or self.thread is None or not self.thread.is_alive() or old is None:
+            return self.connect()
+        changed = [key for key in set(old) | set(params) if old.get(key) != params.get(key)]
+        if len(changed) == 0:
+            LOGGER.info('No params changed')
+            return
+        phases = set(Controller.PARAM_PHASES.get(key,'all') for key in changed)
+        LOGGER.warning(f'Params changed {sorted(changed)}, restarting {sorted(phases)}')
+        if 'all' in phases:
+            return self.connect()
+        self.running_params = params
+        # Options that were removed go back to the default
+        options = {key: params.get(key,ISYHueEmu.default_options.get(key)) for key in changed if key in ISYHueEmu.default_options}
+        if 'hue' in phases:
+            self.isy_hue_emu.restart_hue(self.hue_port,options)
+        elif len(options) > 0:
+            self.isy_hue_emu.set_options(options)
+        if 'record' in options:
+            self.isy_hue_emu.record()
+        if 'isy' in phases:
+            self.isy_hue_emu.set_isy(self.isy_host,self.isy_port,self.isy_user,self.isy_password)
+        self.update_config_docs(force=True)
 
     def handler_log_level(self,level):
         LOGGER.info(f'enter: level={level}')
@@ -263,9 +337,9 @@ class Controller(Node):
         else:
             LOGGER.info("Setting basic config to WARNING...")
             LOG_HANDLER.set_basic_config(True,logging.WARNING)
-        # Always use the requested level for these two
-        logging.getLogger('hueUpnp').setLevel(level['level'])
-        logging.getLogger('ISYHueEmu').setLevel(level['level'])
+        # Always use the requested level for the emulator loggers
+        for name in EMULATOR_LOGGERS:
+            logging.getLogger(name).setLevel(level['level'])
         LOGGER.info(f'exit:')
 
     def get_listen(self):
@@ -298,6 +372,12 @@ class Controller(Node):
                 val = False
         self.setDriver('GV0', 1 if val else 0)
 
+    def set_summary(self,summary):
+        self.setDriver('GV4', summary['events'])
+        self.setDriver('GV5', summary['cmd_ms'])
+        self.setDriver('GV6', summary['queue'])
+        self.setDriver('GV7', summary['reconnects'])
+
     def cmd_update_profile(self,command):
         LOGGER.info('update_profile')
         st = self.poly.installprofile()
@@ -306,6 +386,18 @@ class Controller(Node):
     def cmd_refresh(self,command):
         self.refresh()
 
+    def cmd_dump_log(self,command):
+        if self.isy_hue_emu is False:
+            LOGGER.error('No Hue Emulator?')
+            return
+        self.isy_hue_emu.dump_log()
+
+    def cmd_memory_report(self,command):
+        if self.isy_hue_emu is False:
+            LOGGER.error('No Hue Emulator?')
+            return
+        self.isy_hue_emu.log_memory_report()
+
     def cmd_set_debug_mode(self,command):
         val = int(command.get('value'))
         LOGGER.info(val)
@@ -320,6 +412,8 @@ class Controller(Node):
     commands = {
         'REFRESH': cmd_refresh,
         'UPDATE_PROFILE': cmd_update_profile,
+        'DUMP_LOG': cmd_dump_log,
+        'MEMORY_REPORT': cmd_memory_report,
         'SET_DEBUGMODE': cmd_set_debug_mode,
         'SET_LISTEN': cmd_set_listen,
     }
@@ -327,4 +421,8 @@ class Controller(Node):
         {'driver': 'ST',  'value': 1,  'uom': 25},   # Node Status
         {'driver': 'GV0', 'value': 0,  'uom': 2},   # ISY Connected
         {'driver': 'GV2', 'value': 0,  'uom': 2},   # Listen
+        {'driver': 'GV4', 'value': 0,  'uom': 56},  # ISY Events
+        {'driver': 'GV5', 'value': 0,  'uom': 42},  # ISY Command Time
+        {'driver': 'GV6', 'value': 0,  'uom': 56},  # Command Queue
+        {'driver': 'GV7', 'value': 0,  'uom': 56},  # ISY Reconnects
     ]